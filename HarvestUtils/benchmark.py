@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmark.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+try:
+  import json
+except ImportError:
+  import simplejson as json  # Python 2.5
+
+from config import cfg
+
+log = logging.getLogger("benchmark")
+
+HARVEST_HEADER = "Date,Client,Project,Project Code,Task,Notes,Hours,First Name,Last Name,Billable?,Employee?,Approved?,Hourly Rate,Cost,Department\n"
+TASKS = ["Development", "Meeting", "Kompetensutveckling", "Komptid", "Sjuk", "Semester"]
+NOTES = ["", "fixed bug", "\"review, meeting\"", "\"a \"\"quoted\"\" note\""]
+OFFICES = ["Gothenburg", "Stockholm", "Malmo"]
+YEAR = 2009  # The first month is January this year
+MIN_SECONDS = 0.05  # Benchmarks faster than this are too noisy to compare
+
+def generate(directory, employees=40, customers=10, months=12, rows=100000, seed=1):
+  """
+    Write a Harvest export of rows time entries by employees over the
+    customers (with three projects each and the Internal one) and the first
+    months months from YEAR, and the PO and coworker files that go with
+    it, to directory. The same arguments always give the same files.
+    Returns the paths of (Harvest, PO, coworker) file.
+  """
+  rand = random.Random(seed)
+  names = [("First%d" % i, "Last%d" % i) for i in range(employees)]
+  clients = ["Customer %d" % i for i in range(customers)]
+  days = []
+  for month in range(months):
+    for day in range(1, 29):
+      days.append("%d-%02d-%02d" % (YEAR + month / 12, month % 12 + 1, day))
+
+  paths = [os.path.join(directory, name) for name in ("harvest.csv", "po.csv", "coworkers.csv")]
+  out = file(paths[0], 'w')
+  out.write(HARVEST_HEADER)
+  for i in xrange(rows):
+    (first, last) = rand.choice(names)
+    project = rand.choice(["Project A", "Project B", "Project C", "Internal"])
+    billable = rand.choice(["billable", "non-billable"])
+    out.write("%s,%s,%s,,%s,%s,%0.2f,%s,%s,%s,employee,yes,0.0,0.0,Dev\n" %
+              (rand.choice(days), rand.choice(clients), project, rand.choice(TASKS),
+               rand.choice(NOTES), rand.randint(1, 16) / 2.0, first, last, billable))
+  out.close()
+
+  out = file(paths[1], 'w')
+  out.write("employee,customer,reference,price,start,stop,po-number\n")
+  for i, (first, last) in enumerate(names):
+    out.write("%s %s,%s,Ref %d,900,%s,%s,%d\n" % (first, last, clients[i % customers], i, days[0], days[-1], 1000 + i))
+  out.close()
+
+  out = file(paths[2], 'w')
+  out.write("employee,employee number,branch office\n")
+  for i, (first, last) in enumerate(names):
+    out.write("%s %s,%d,%s\n" % (first, last, i, OFFICES[i % len(OFFICES)]))
+  out.close()
+  return paths
+
+def _timed(function, repeat=1):
+  "The best time of repeat calls of function, in seconds."
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    if best is None or seconds < best:
+      best = seconds
+  return best
+
+def run(directory, employees=40, customers=10, months=12, rows=100000, seed=1, repeat=3):
+  """
+    Generate the files in directory, load them into a new DB there and time
+    each step. Returns the results as a dict that can be written as JSON:
+    the scale and, per benchmark, its seconds and how many rows it handled.
+    The DB of config.py is not touched.
+  """
+  paths = generate(directory, employees, customers, months, rows, seed)
+  db = os.path.join(directory, "harvest.sqlite")
+  if os.path.exists(db):
+    os.unlink(db)
+  cfg['db.bind'] = "sqlite:///%s" % db
+  # Imported after the DB has been set, model.py binds it when imported
+  from csvparser import CSVFile
+  from mapper import CSVDBMapper, POMapper, CWMapper
+  from model import TimeEntry
+  from statistics_month import DateModel, Statistics
+  report = __import__("monthly-report")
+
+  results = {}
+  def result(name, seconds, count):
+    log.info("%s: %0.3f seconds for %d rows" % (name, seconds, count))
+    results[name] = { 'seconds': seconds, 'rows': count }
+
+  def parse():
+    for entry in CSVFile(paths[0], TimeEntry):
+      pass
+  result('parse', _timed(parse, repeat), rows)
+
+  # Each file is loaded once, in the order update_db.py is usually run
+  for (name, mapper, path, count) in [('map_coworkers', CWMapper, paths[2], employees),
+                                      ('map_purchase_orders', POMapper, paths[1], employees),
+                                      ('map_harvest', CSVDBMapper, paths[0], rows)]:
+    result(name, _timed(mapper(path).map), count)
+
+  periods = ["%d-%02d" % (YEAR + month / 12, month % 12 + 1) for month in range(months)]
+  names = [u"First%d Last%d" % (i, i) for i in range(employees)]
+  def by_employee():
+    for period in periods:
+      stats = Statistics(DateModel("%s-01" % period))
+      for name in names:
+        stats.by_employee(name)
+  result('statistics_by_employee', _timed(by_employee, repeat), len(periods) * len(names))
+
+  def get_report():
+    for period in periods:
+      report.MonthlyReport(period).get_report()
+  result('monthly_report', _timed(get_report, repeat), len(periods))
+
+  import snapshot
+  path = os.path.join(directory, "harvest.snapshot")
+  exported = [0]  # The daily hours in the snapshot, not the Harvest rows
+  def export():
+    exported[0] = snapshot.export(path)
+  result('snapshot_export', _timed(export), exported[0])
+  result('snapshot_load', _timed(lambda: snapshot.Snapshot(path), repeat), exported[0])
+  hours = snapshot.Snapshot(path)
+  def snapshot_by_employee():
+    for period in periods:
+      stats = Statistics(DateModel("%s-01" % period), snapshot=hours)
+      for name in names:
+        stats.by_employee(name)
+  result('snapshot_by_employee', _timed(snapshot_by_employee, repeat), len(periods) * len(names))
+
+  return { 'scale': { 'employees': employees, 'customers': customers, 'months': months,
+                      'rows': rows, 'seed': seed },
+           'python': sys.version.split()[0],
+           'results': results }
+
+def compare(results, baseline, threshold=0.2):
+  """
+    Compare the results of run() with those of an earlier run. Returns a
+    list of (benchmark, baseline seconds, seconds, ratio, True if it is
+    more than threshold slower), for the benchmarks that are in both.
+    Runs shorter than MIN_SECONDS never count as slower.
+  """
+  if results['scale'] != baseline['scale']:
+    log.warning("The baseline was run at another scale: %s" % baseline['scale'])
+  comparison = []
+  for name in sorted(results['results'].keys()):
+    if not baseline['results'].has_key(name):
+      continue
+    old = baseline['results'][name]['seconds']
+    new = results['results'][name]['seconds']
+    ratio = new / max(old, 0.001)
+    comparison.append((name, old, new, ratio, ratio > 1 + threshold and new > MIN_SECONDS))
+  return comparison
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=cfg['loglevel'],format=cfg['logformat'])
+  parser = OptionParser(usage="Usage: python benchmark.py [options]")
+  parser.add_option("--employees", dest="employees", type="int", default=40)
+  parser.add_option("--customers", dest="customers", type="int", default=10)
+  parser.add_option("--months", dest="months", type="int", default=12)
+  parser.add_option("--rows", dest="rows", type="int", default=100000,
+                    help="number of Harvest entries (default 100000)")
+  parser.add_option("--seed", dest="seed", type="int", default=1)
+  parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                    help="runs of the read only benchmarks, the best one counts (default 3)")
+  parser.add_option("-d", "--dir", dest="directory",
+                    help="where the files and the DB go, kept afterwards (default a temporary directory)")
+  parser.add_option("-o", "--output", dest="output",
+                    help="write the results as JSON to this file")
+  parser.add_option("-b", "--baseline", dest="baseline",
+                    help="compare with the JSON results of an earlier run")
+  parser.add_option("--threshold", dest="threshold", type="float", default=0.2,
+                    help="how much slower than the baseline is a regression (default 0.2 for 20%)")
+  (options, args) = parser.parse_args()
+
+  directory = options.directory
+  if directory is None:
+    directory = tempfile.mkdtemp(prefix="harvest-benchmark")
+  elif not os.path.exists(directory):
+    os.makedirs(directory)
+  try:
+    results = run(directory, options.employees, options.customers, options.months,
+                  options.rows, options.seed, options.repeat)
+  finally:
+    if options.directory is None:
+      shutil.rmtree(directory)
+
+  if options.output is not None:
+    out = file(options.output, 'w')
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.close()
+  else:
+    print json.dumps(results, indent=2, sort_keys=True)
+
+  if options.baseline is not None:
+    handle = file(options.baseline)
+    baseline = json.load(handle)
+    handle.close()
+    regressions = 0
+    for (name, old, new, ratio, slower) in compare(results, baseline, options.threshold):
+      print "%-24s %8.3f s %8.3f s %6.2fx%s" % (name, old, new, ratio, slower and "  REGRESSION" or "")
+      if slower:
+        regressions += 1
+    if regressions > 0:
+      sys.exit(1)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+check_schema.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import sys
+from optparse import OptionParser
+
+from config import cfg
+from model import *
+from statistics_month import DateModel, Statistics, WeekStatistics, HOURS_BY_TASK
+
+def report_queries(period):
+  """
+    The queries of monthly-report.py and statistics_month.py for a month,
+    as a list of (description, select).
+  """
+  date = DateModel("%s-01" % period)
+  stats = Statistics(date)
+  weeks = WeekStatistics(date.year, cfg['purple_heart'][date.month])
+  return [("Statistics.hours_by_task", stats.aggregate_query(HOURS_BY_TASK)),
+          ("Statistics.by_employee", stats.aggregate_query(('task',), employee=u"")),
+          ("Statistics.by_office", stats.aggregate_query(('office', 'week', 'billable'))),
+          ("Statistics.purchase_orders", stats.purchase_orders_query().statement),
+          ("WeekStatistics", weeks.query()),
+          ("WeekStatistics.internal", weeks.internal_query())]
+
+def explain(query):
+  "The details of the EXPLAIN QUERY PLAN rows of query."
+  compiled = query.compile(bind=metadata.bind)
+  params = compiled.construct_params()
+  connection = metadata.bind.raw_connection()
+  try:
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN %s" % compiled, [params[name] for name in compiled.positiontup])
+    return [row[-1] for row in cursor.fetchall()]
+  finally:
+    connection.close()
+
+def full_scans(plan):
+  """
+    The steps of a plan that read a whole table. Depending on the SQLite
+    version they read "SCAN TABLE x", "SCAN x" or "TABLE x", without an
+    index or primary key.
+  """
+  scans = []
+  for detail in plan:
+    if detail.startswith("SCAN") or detail.startswith("TABLE"):
+      if "INDEX" not in detail and "PRIMARY KEY" not in detail:
+        scans.append(detail)
+  return scans
+
+if __name__ == "__main__":
+  parser = OptionParser(usage="Usage: check_schema.py [YYYY-MM]")
+  (options, args) = parser.parse_args()
+  if len(args) > 0:
+    period = args[0]
+  else:
+    period = DateModel().get_month_start()[:7]
+
+  failed = 0
+  for (name, query) in report_queries(period):
+    plan = explain(query)
+    scans = full_scans(plan)
+    if len(scans) > 0:
+      failed += 1
+      print "FULL SCAN %s" % name
+    else:
+      print "ok %s" % name
+    for detail in plan:
+      print "\t%s" % detail
+
+  if failed > 0:
+    print "%d of the queries scan whole tables, check the INDEXES in model.py" % failed
+    sys.exit(1)
@@ -22,17 +22,175 @@ You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import array
+import cStringIO
+import csv
 import inspect
 import logging
+import mmap
+import operator
 import os
+import shutil
+import tempfile
 import time
 import unittest
 
+import instrument
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None  # Python 2.5, everything is parsed in one process
+
 log = logging.getLogger("csvparser")
 
+class _OffsetLines(object):
+  """
+    Iterates over lines and keeps the byte offset after the last line
+    handed out. The csv module only asks for the lines of one row at a
+    time, so after a row is parsed this is where the next row starts.
+  """
+  def __init__(self,lines,offset):
+    self.lines = iter(lines)
+    self.offset = offset
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line = self.lines.next()
+    self.offset += len(line)
+    return line
+
+class Schema(object):
+  """
+    A type of CSV file: its header and, for every column, the attribute of
+    cls it goes to and how it is converted. The columns are compiled into
+    one decode() function that turns the decoded fields of a row into a cls
+    instance without calling cls.__init__: unused columns are dropped,
+    values converted and checked in the same go. A bad value raises
+    ValueError, or KeyError for a value that is not in a dict, and the row
+    is thrown away like one with the wrong number of fields. Register
+    schemas with register(), see model.py.
+    @param name is what the file type is called in the log
+    @param cls is the class of the decoded rows
+    @param columns is a list of (header, attribute, convert), attribute None
+           to drop the column and convert a dict (e.g. a model._Shared), a
+           function or None to keep the text. None makes a schema that
+           passes the fields to cls() as they are, as many as it takes.
+  """
+
+  def __init__(self,name,cls,columns=None):
+    self.name = name
+    self.cls = cls
+    self.columns = columns
+    if columns is None:
+      # Determine the number of arguments to pass to the constructor (-1
+      # for self)
+      self.length = len(inspect.getargspec(cls.__init__)[0]) - 1
+      self.header = None
+      self.decode = lambda fields: cls(*fields)
+    else:
+      self.length = len(columns)
+      self.header = [Schema.normalize(header) for (header, attribute, convert) in columns]
+      self.decode = self._compile()
+
+  def normalize(header):
+    "A column header the way headers are compared."
+    return header.strip().lower()
+  normalize = staticmethod(normalize)
+
+  def _compile(self):
+    """
+      Generate the source of decode() for the columns and compile it, the
+      way collections.namedtuple makes its classes. Fields, converters and
+      attributes are all locals, dicts are looked up with [] and there is
+      no loop, so a row costs about what a hand written function would.
+    """
+    fields = ["f%d" % i for i in range(len(self.columns))]
+    scope = { '_new': object.__new__, '_cls': self.cls }
+    body = ["  (%s,) = fields" % ", ".join(fields),
+            "  entry = _new(_cls)"]
+    for i, (header, attribute, convert) in enumerate(self.columns):
+      if attribute is None:
+        continue
+      value = fields[i]
+      if isinstance(convert, dict):
+        value = "_c%d[%s]" % (i, value)
+      elif convert is not None:
+        value = "_c%d(%s)" % (i, value)
+      if convert is not None:
+        scope["_c%d" % i] = convert
+      body.append("  entry.%s = %s" % (attribute, value))
+    # Everything it uses is bound as a default argument, which is faster to
+    # get at than a global
+    names = ", ".join(["%s=%s" % (name, name) for name in sorted(scope.keys())])
+    source = ["def decode(fields, %s):" % names] + body + ["  return entry"]
+    exec "\n".join(source) + "\n" in scope
+    return scope['decode']
+
+  def convert(self,entry,fields):
+    """
+      Set the attributes of entry from fields the way decode() does, for
+      the __init__ of cls. Then both convert with the same columns.
+    """
+    for (header, attribute, convert), value in zip(self.columns, fields):
+      if attribute is None:
+        continue
+      if isinstance(convert, dict):
+        value = convert[value]
+      elif convert is not None:
+        value = convert(value)
+      setattr(entry, attribute, value)
+
+  def __repr__(self):
+    return '<Schema "%s">' % self.name
+
+_schemas = []  # See register()
+
+def register(schema):
+  "Add schema to the file types of sniff() and schema_of(). Returns schema."
+  _schemas.append(schema)
+  return schema
+
+def schema_of(cls):
+  "The registered Schema of cls, or one that passes the fields to cls()."
+  for schema in _schemas:
+    if schema.cls is cls:
+      return schema
+  return Schema(cls.__name__, cls)
+
+def sniff(filepath):
+  """
+    The registered Schema of a file: the one whose header is the first line
+    of the file, or else the only one with as many columns. None if there
+    is no such schema.
+  """
+  handle = file(filepath, 'rb')
+  try:
+    header = csv.reader(handle, skipinitialspace=True).next()
+  except StopIteration:
+    header = []
+  handle.close()
+  header = [Schema.normalize(column) for column in header]
+  for schema in _schemas:
+    if schema.header == header:
+      return schema
+  schemas = [schema for schema in _schemas if schema.length == len(header)]
+  if len(schemas) == 1:
+    log.info("Unknown header in %s, going by its %d columns it is a %s file" % (filepath, len(header), schemas[0].name))
+    return schemas[0]
+  return None
+
 class CSVFile(object):
   """
     This class represents a generic CSV-file and parses the file line by line.
+    Fields are tokenized by the csv module, so quoted fields may contain
+    commas, quotes and newlines, and leading spaces in a field are skipped.
+    Rows are decoded by the Schema of cls, see schema_of(). Lines with the
+    wrong number of fields or a bad value are thrown away and counted in
+    self.rejected. position() and seek() make it possible to continue
+    reading where an earlier run stopped.
     @param filepath is the path to the file
     @param clz is the class that should be instansiated with the parsed values
     @param skip_header is a boolean that is true if the first line is a 
@@ -45,50 +203,122 @@ class CSVFile(object):
   def __init__(self,filepath,cls,skip_header=True):
     self.file = self._open(filepath,None) 
     self.cls = cls
-    # Determine the number of arguments to pass to the constructor (-1 for
-    # self)
-    self.length = len(inspect.getargspec(self.cls.__init__)[0]) - 1
+    self.schema = schema_of(cls)
+    self.length = self.schema.length
     if skip_header:
       self.header = self.file.readline()
       log.debug("skip_header is True, throwing away: '%s'" % self.header)
     self.lineno = 0
+    self.rejected = 0
+    self.lines = None
+    self.rows = self._read()
 
   def next(self):
-    self._open(self.file.name, CSVFile.READ)  # Just a check that we are in read-mode and at the right position.
-    line = unicode(self.file.readline(), 'utf-8')
-    if line:
-      self.lineno+=1
-      log.debug("CSVFile.next(): parsing line '%s'" % line.strip())
-      return self._parse_line(line.strip())
-    else:
-      log.debug("CSVFile.next() reached end of file, starting from top next time")
-      raise StopIteration
+    return self.rows.next()
+
+  def position(self):
+    """
+      Return (byte offset, line number) of the row after the last one that
+      was returned.
+    """
+    if self.lines is None:
+      return (self.file.tell(), self.lineno)
+    return (self.lines.offset, self.lineno)
+
+  def seek(self,offset,lineno):
+    "Continue reading at a position returned by position()."
+    self.rows = self._read(offset, lineno)
 
   def serialize(self,*args):
     self._open(self.file.name, CSVFile.WRITE)
-    str = ""
-    for arg in args:
-      str = str + "%s," %arg
-    str = str.rstrip(",")
-    self.file.write("%s\n" % str)
-    return str
-    
-  def _parse_line(self,line):
-    args = line.split(",")
-    args = [x.strip() for x in args]
-    if not len(args) == self.length:
-      log.warning("Number of parsed tokens is not equal to the predetermined number of tokens (%d,%d), line %d" % (len(args),self.length, self.lineno))
-      log.warning("Throwing away line '%s'" % line)
-      return self.next()
-    else:
-      return self.cls(*tuple(args))
-
-  def _setoflines(self):
-    curr = self.file.tell()
-    self.file.seek(0)
-    lines = [x.strip() for x in self.file.readlines()]
-    self.file.seek(curr)
-    return set(lines)
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow([self._encode(arg) for arg in args])
+    str = buf.getvalue()
+    self.file.write(str)
+    # Reading starts over from the top of the file next time
+    self.rows = self._read()
+    return str.rstrip("\n")
+
+  def _encode(self,arg):
+    if isinstance(arg, unicode):
+      return arg.encode('utf-8')
+    return arg
+
+  def batches(self,cls,size=10000):
+    """
+      Generator that yields the rest of the file in batches of at most size
+      rows instead of one instance per row. cls is a batch class like
+      model.TimeEntryBatch: a new batch is cls(), each row is added with
+      append(fields), a full batch is handed out by freeze() and the rows
+      after it go into next_batch(). position() after a batch is the
+      position after its last row. A line that append() raises ValueError
+      or KeyError for is thrown away and counted in self.rejected.
+    """
+    batch = cls()
+    stage = instrument.start("parse")
+    for fields in self.fields:
+      try:
+        batch.append(fields)
+      except (ValueError, KeyError), e:
+        self.rejected+=1
+        log.warning("Bad value (%s), throwing away line %d" % (e, self.lineno))
+        continue
+      if len(batch) >= size:
+        batch = batch.freeze()
+        instrument.stop(stage, len(batch))
+        yield batch
+        batch = batch.next_batch()
+        stage = instrument.start("parse")
+    instrument.stop(stage, len(batch))
+    if len(batch) > 0:
+      yield batch.freeze()
+
+  def _read(self,offset=None,lineno=None):
+    """
+      Start reading at offset, or at the top of the file. Returns an iterator
+      with one cls instance per valid line, self.fields has the same lines
+      as lists of fields. Only one of them can be read.
+    """
+    self.fields = self._fields(offset, lineno)
+    return self._fields(offset, lineno, self.schema.decode)
+
+  def _fields(self,offset=None,lineno=None,decode=None):
+    """
+      Generator that yields the decoded fields of every valid line, or what
+      decode() makes of them. The file is (re)opened in read mode once, not
+      checked for every line.
+    """
+    self._open(self.file.name, CSVFile.READ)
+    if offset is not None:
+      self.file.seek(offset)
+      self.lineno = lineno
+    self.lines = _OffsetLines(self.file, self.file.tell())
+    length = self.length
+    join = "\0".join
+    strip = unicode.strip
+    for row in csv.reader(self.lines, skipinitialspace=True):
+      self.lineno+=1
+      if len(row) == length:
+        # Decoding the whole row at once is a lot faster than field by field.
+        # The csv module only drops the blanks in front of a field.
+        fields = map(strip, unicode(join(row), 'utf-8').split(u"\0"))
+        if decode is None:
+          yield fields
+          continue
+        try:
+          entry = decode(fields)
+        except (ValueError, KeyError), e:
+          self.rejected+=1
+          log.warning("Bad value (%s), throwing away line %d" % (e, self.lineno))
+          continue
+        yield entry
+      else:
+        self.rejected+=1
+        log.warning("Number of parsed tokens is not equal to the predetermined number of tokens (%d,%d), throwing away line %d" % (len(row),length, self.lineno))
+    if self.rejected > 0:
+      log.warning("%d of %d lines in %s were thrown away" % (self.rejected, self.lineno, self.file.name))
+    log.debug("CSVFile.next() reached end of file, starting from top next time")
 
   def _open(self,filepath,mode):
     if mode is None:
@@ -102,15 +332,347 @@ class CSVFile(object):
         self.file = file(filepath,mode)
 
   def __iter__(self):
-    return self
+    return self.rows
 
-  def __sub__(self,other):
+  def diff(self,other,memory=None):
+    "Return a CSVDiff with the lines added to this file compared to other."
     if not isinstance(other,CSVFile):
       raise Exception, "Only two CSVFiles can be used for this operation"
+    for csvfile in (self, other):
+      if csvfile.file.mode == CSVFile.WRITE:
+        csvfile.file.flush()
+    return CSVDiff(self.file.name, other.file.name, memory)
+
+  def __sub__(self,other):
+    "Return the set of lines in this file that are not in other."
+    return set(self.diff(other).added())
+
+
+class CSVDiff(object):
+  """
+    The lines that differ between two files, compared as stripped lines
+    the way CSVFile.__sub__ always has. Files bigger than memory are split
+    into partitions by the hash of each line, spilled to temporary files,
+    and compared one partition at a time. Only one byte per line is kept for
+    the whole file, so the added and removed lines can be streamed in their
+    original order afterwards.
+    @param new is the path to the newer file
+    @param old is the path to the older file
+    @param memory is roughly how many bytes of lines to hold at once
+    @param tmpdir is where the partitions are spilled, None for the default
+  """
+
+  MEMORY = 64*1024*1024
+
+  def __init__(self,new,old,memory=None,tmpdir=None):
+    self.new = new
+    self.old = old
+    if memory is None:
+      memory = CSVDiff.MEMORY
+    self.memory = memory
+    self.tmpdir = tmpdir
+    self.new_flags = None
+    self.old_flags = None
+    self.added_count = 0
+    self.removed_count = 0
+
+  def added(self):
+    "Generator that yields the lines of new that are not in old, in order."
+    self._compare()
+    return self._flagged(self.new, self.new_flags)
+
+  def removed(self):
+    "Generator that yields the lines of old that are not in new, in order."
+    self._compare()
+    return self._flagged(self.old, self.old_flags)
+
+  def counts(self):
+    "Return (number of added lines, number of removed lines)."
+    self._compare()
+    return (self.added_count, self.removed_count)
+
+  def _compare(self):
+    if self.new_flags is not None:
+      return
+    size = os.path.getsize(self.new) + os.path.getsize(self.old)
+    parts = int(size / self.memory) + 1
+    tmpdir = None
+    if parts > 1:
+      tmpdir = tempfile.mkdtemp(prefix="csvdiff", dir=self.tmpdir)
+      log.debug("Diffing %s and %s in %d partitions under %s" % (self.new, self.old, parts, tmpdir))
+    try:
+      (new_parts, new_lines) = self._split(self.new, parts, tmpdir, "new")
+      (old_parts, old_lines) = self._split(self.old, parts, tmpdir, "old")
+      self.new_flags = array.array('B', [0]) * new_lines
+      self.old_flags = array.array('B', [0]) * old_lines
+      for i in range(parts):
+        new_part = self._load(new_parts[i])
+        old_part = self._load(old_parts[i])
+        self.added_count += self._mark(new_part, old_part, self.new_flags)
+        self.removed_count += self._mark(old_part, new_part, self.old_flags)
+    finally:
+      if tmpdir is not None:
+        shutil.rmtree(tmpdir)
+
+  def _split(self,path,parts,tmpdir,name):
+    """
+      Return (one list of (lineno, line) or one spill file per partition,
+      number of lines in path).
+    """
+    lineno = 0
+    if parts == 1:
+      lines = []
+      for line in file(path, 'r'):
+        lines.append((lineno, line.strip()))
+        lineno+=1
+      return ([lines], lineno)
+
+    paths = [os.path.join(tmpdir, "%s.%d" % (name, i)) for i in range(parts)]
+    outs = [file(p, 'w') for p in paths]
+    try:
+      for line in file(path, 'r'):
+        line = line.strip()
+        outs[hash(line) % parts].write("%d %s\n" % (lineno, line))
+        lineno+=1
+    finally:
+      for out in outs:
+        out.close()
+    return (paths, lineno)
+
+  def _load(self,part):
+    if isinstance(part, list):
+      return part
+    lines = []
+    for line in file(part, 'r'):
+      (lineno, line) = line.rstrip("\n").split(" ", 1)
+      lines.append((int(lineno), line))
+    return lines
+
+  def _mark(self,part,other,flags):
+    "Flag the lines of part that are not in other, return how many there were."
+    others = set([line for (lineno, line) in other])
+    count = 0
+    for (lineno, line) in part:
+      if not line in others:
+        flags[lineno] = 1
+        count+=1
+    return count
+
+  def _flagged(self,path,flags):
+    lineno = 0
+    for line in file(path, 'r'):
+      if flags[lineno]:
+        yield line.strip()
+      lineno+=1
+
+
+
+def _parse_range(args):
+  """
+    Parse the bytes start to stop of a CSV file into a list of tuples with
+    the attributes fields of cls. Runs in the worker processes of
+    ParallelCSVFile and returns (rows, ends, number of lines, rejected
+    lines), where ends holds the (byte offset, line count) after each row.
+  """
+  (filepath, cls, fields, start, stop) = args
+  schema = schema_of(cls)
+  length = schema.length
+  decode = schema.decode
+  handle = file(filepath, 'rb')
+  mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+  data = mm[start:stop]
+  mm.close()
+  handle.close()
+
+  get = operator.attrgetter(*fields)
+  if len(fields) == 1:
+    # attrgetter only returns a tuple for two or more attributes
+    one = get
+    get = lambda entry: (one(entry),)
+  join = "\0".join
+  strip = unicode.strip
+  lines = _OffsetLines(cStringIO.StringIO(data), start)
+  rows = []
+  ends = []
+  lineno = 0
+  rejected = 0
+  for row in csv.reader(lines, skipinitialspace=True):
+    lineno+=1
+    if len(row) == length:
+      try:
+        rows.append(get(decode(map(strip, unicode(join(row), 'utf-8').split(u"\0")))))
+      except (ValueError, KeyError):
+        rejected+=1
+        continue
+      ends.append((lines.offset, lineno))
     else:
-      return self._setoflines() - other._setoflines()
+      rejected+=1
+  return (rows, ends, lineno, rejected)
 
 
+class ParallelCSVFile(object):
+  """
+    Parses a CSV file in a pool of processes. The file is memory-mapped and
+    split into byte ranges that end on a line break outside of quotes, each
+    range is parsed by a worker and the rows come back as batches of tuples
+    with the given attributes of each cls instance, in file order.
+    Without the multiprocessing module (Python 2.5) or with one process the
+    ranges are parsed in this process. Like CSVFile it has position() and
+    seek() to continue where an earlier run stopped.
+    @param filepath is the path to the file
+    @param cls is the class that should be instansiated with the parsed values
+    @param fields is a list of attribute names to pick from each instance
+    @param processes is the number of worker processes, None for one per CPU
+    @param chunk_size is the approximate number of bytes per range
+    @param skip_header is a boolean that is true if the first line is a 
+           header and should be skipped
+  """
+
+  # Ranges in flight per process, see _window()
+  WINDOW = 2
+
+  def __init__(self,filepath,cls,fields,processes=None,chunk_size=8*1024*1024,skip_header=True):
+    self.filepath = filepath
+    self.cls = cls
+    self.fields = tuple(fields)
+    if multiprocessing is None:
+      processes = 1
+    elif processes is None:
+      processes = multiprocessing.cpu_count()
+    self.processes = processes
+    self.chunk_size = chunk_size
+    self.skip_header = skip_header
+    self.start = None
+    self.offset = None
+    self.lineno = 0
+    self.rejected = 0
+
+  def position(self):
+    """
+      Return (byte offset, line number) of the row after the last one that
+      was returned.
+    """
+    if self.offset is None:
+      return (self._first_row(), self.lineno)
+    return (self.offset, self.lineno)
+
+  def seek(self,offset,lineno):
+    "Start reading at a position returned by position()."
+    self.start = offset
+    self.offset = offset
+    self.lineno = lineno
+
+  def batches(self):
+    "Generator that yields one list of row tuples per byte range."
+    for (rows, ends) in self._results():
+      yield rows
+
+  def __iter__(self):
+    for (rows, ends) in self._results():
+      lineno = self.lineno
+      for i in xrange(len(rows)):
+        (self.offset, self.lineno) = ends[i]
+        self.lineno += lineno
+        yield rows[i]
+
+  def _results(self):
+    """
+      Generator that yields (rows, ends) per byte range, with self.offset
+      and self.lineno at the start of the range.
+    """
+    jobs = [(self.filepath, self.cls, self.fields, start, stop) for (start, stop) in self._ranges()]
+    if self.processes > 1 and len(jobs) > 1:
+      pool = multiprocessing.Pool(self.processes)
+      results = self._window(pool, jobs)
+    else:
+      pool = None
+      results = (_parse_range(job) for job in jobs)
+    try:
+      for i, (rows, ends, lines, rejected) in enumerate(instrument.timed("parse", results, lambda result: len(result[0]))):
+        self.offset = jobs[i][3]
+        lineno = self.lineno
+        self.rejected += rejected
+        yield (rows, ends)
+        (self.offset, self.lineno) = (jobs[i][4], lineno + lines)
+    finally:
+      if pool is not None:
+        pool.terminate()
+    if self.rejected > 0:
+      log.warning("%d of %d lines in %s were thrown away" % (self.rejected, self.lineno, self.filepath))
+
+  def _window(self, pool, jobs):
+    """
+      Yield the results of jobs in order, parsed by pool. At most
+      WINDOW ranges per process are handed out ahead of the one being
+      consumed, so a slow consumer does not collect the whole file.
+    """
+    window = ParallelCSVFile.WINDOW * self.processes
+    pending = []
+    for job in jobs:
+      pending.append(pool.apply_async(_parse_range, (job,)))
+      if len(pending) >= window:
+        yield pending.pop(0).get()
+    while len(pending) > 0:
+      yield pending.pop(0).get()
+
+  def _first_row(self):
+    "Return the byte offset of the first row."
+    if self.start is not None:
+      return self.start
+    if not self.skip_header or os.path.getsize(self.filepath) == 0:
+      return 0
+    handle = file(self.filepath, 'rb')
+    try:
+      mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        return self._line_end(mm, 0, 0)
+      finally:
+        mm.close()
+    finally:
+      handle.close()
+
+  def _ranges(self):
+    """
+      Split the file into (start, stop) byte ranges. A range may only end on
+      a line break with an even number of quotes before it, otherwise the
+      line break is part of a quoted field.
+    """
+    size = os.path.getsize(self.filepath)
+    if size == 0:
+      return []
+    handle = file(self.filepath, 'rb')
+    mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      start = self.start
+      if start is None:
+        start = 0
+        if self.skip_header:
+          start = self._line_end(mm, 0, 0)
+      ranges = []
+      while start < size:
+        stop = self._line_end(mm, start, min(start + self.chunk_size, size) - 1)
+        ranges.append((start, stop))
+        start = stop
+      return ranges
+    finally:
+      mm.close()
+      handle.close()
+
+  def _line_end(self, mm, start, pos):
+    """
+      Return the position after the first line break at or after pos that
+      is not inside a quoted field of the line that starts at start.
+    """
+    quotes = 0
+    while True:
+      nl = mm.find("\n", pos)
+      if nl < 0:
+        return mm.size()
+      quotes += mm[start:nl + 1].count('"')
+      if quotes % 2 == 0:
+        return nl + 1
+      start = pos = nl + 1
+
 
 # Unit test cases below this line
 #----------------------------------------------------------------------------
@@ -177,6 +739,59 @@ class TestCSVFile(unittest.TestCase):
     self.assertEquals("2", first.b)
     self.assertEquals("2", first.c)
 
+  def testQuotedFields(self):
+    out = file(self.OUTPUT, 'w')
+    out.write('a,"b, with comma",c\n1,"say ""hi""",3\n')
+    out.close()
+
+    csvtest = CSVFile(self.OUTPUT, Dummy, skip_header=False)
+    first = csvtest.next()
+    self.assertEquals("b, with comma", first.b)
+    second = csvtest.next()
+    self.assertEquals('say "hi"', second.b)
+
+  def testStrippedFields(self):
+    out = file(self.OUTPUT, 'w')
+    out.write('a,b,c\n 1 ,plain , "quoted " \n')
+    out.close()
+
+    get = operator.attrgetter('a', 'b', 'c')
+    self.assertEquals([(u"1", u"plain", u"quoted")], [get(e) for e in CSVFile(self.OUTPUT, Dummy)])
+    self.assertEquals([(u"1", u"plain", u"quoted")], list(ParallelCSVFile(self.OUTPUT, Dummy, ('a', 'b', 'c'), 1)))
+
+  def testSerializeQuoted(self):
+    csvtest = CSVFile(self.OUTPUT, Dummy, skip_header=False)
+    csvtest.serialize("1",u"two, and more","3")
+    first = csvtest.next()
+    self.assertEquals(u"two, and more", first.b)
+
+  def testRejectedLines(self):
+    out = file(self.OUTPUT, 'w')
+    out.write("bad,line\n" * 5000)
+    out.write("1,2,3\n")
+    out.close()
+
+    csvtest = CSVFile(self.OUTPUT, Dummy, skip_header=False)
+    items = [e for e in csvtest]
+    self.assertEquals(1, len(items))
+    self.assertEquals(5000, csvtest.rejected)
+
+  def testResume(self):
+    out = file(self.OUTPUT, 'w')
+    out.write('a,b,c\n1,"two\nlines",3\n4,5,6\n7,8,9\n')
+    out.close()
+
+    csvtest = CSVFile(self.OUTPUT, Dummy)
+    csvtest.next()
+    (offset, lineno) = csvtest.position()
+    self.assertEquals(len('a,b,c\n1,"two\nlines",3\n'), offset)
+    self.assertEquals(1, lineno)
+
+    resumed = CSVFile(self.OUTPUT, Dummy)
+    resumed.seek(offset, lineno)
+    self.assertEquals(['4', '7'], [e.a for e in resumed])
+    self.assertEquals(3, resumed.lineno)
+
   def testDiff(self):
     self.TESTA = "./testdata/test_a"
     self.TESTB = "./testdata/test_b"
@@ -203,6 +818,128 @@ class TestCSVFile(unittest.TestCase):
     f = c.next()
     self.assertEquals('6', f.a)
 
+  def testDiffPartitioned(self):
+    out = file(self.OUTPUT, 'w')
+    out.write("".join(["%d,x,y\n" % i for i in range(1000)]))
+    out.close()
+    other = self.OUTPUT + ".old"
+    out = file(other, 'w')
+    out.write("".join(["%d,x,y\n" % i for i in range(1000) if i % 7 != 0]))
+    out.write("gone,x,y\n")
+    out.close()
+
+    try:
+      for memory in (None, 1000):
+        diff = CSVDiff(self.OUTPUT, other, memory)
+        added = list(diff.added())
+        self.assertEquals(["%d,x,y" % i for i in range(0, 1000, 7)], added)
+        self.assertEquals(["gone,x,y"], list(diff.removed()))
+        self.assertEquals((143, 1), diff.counts())
+    finally:
+      os.unlink(other)
+
+class TestSchema(unittest.TestCase):
+
+  def setUp(self):
+    self.OUTPUT = "./testdata/%s-testschema.csv" % time.strftime("%Y-%m-%d_%H%M%S", time.localtime())
+    self.schema = Schema("Dummy", Dummy, [(" A", 'a', None), ("B ", 'b', float), ("c", 'c', {u"x": 1, u"y": 2})])
+
+  def tearDown(self):
+    if os.path.exists(self.OUTPUT):
+      os.unlink(self.OUTPUT)
+    if self.schema in _schemas:
+      _schemas.remove(self.schema)
+
+  def testDecode(self):
+    entry = self.schema.decode([u"1", u"2.5", u"y"])
+    self.assert_(isinstance(entry, Dummy))
+    self.assertEquals((u"1", 2.5, 2), (entry.a, entry.b, entry.c))
+    self.assertRaises(ValueError, self.schema.decode, [u"1", u"two", u"y"])
+    self.assertRaises(KeyError, self.schema.decode, [u"1", u"2.5", u"z"])
+
+  def testConvert(self):
+    entry = Dummy(None, None, None)
+    self.schema.convert(entry, [u"1", u"2.5", u"y"])
+    self.assertEquals((u"1", 2.5, 2), (entry.a, entry.b, entry.c))
+
+  def testBadValues(self):
+    out = file(self.OUTPUT, 'w')
+    out.write("a,b,c\n1,2,x\n2,two,x\n3,4,y\n4,5,z\n")
+    out.close()
+    register(self.schema)
+    csvtest = CSVFile(self.OUTPUT, Dummy)
+    self.assertEquals([(u"1", 2.0), (u"3", 4.0)], [(e.a, e.b) for e in csvtest])
+    self.assertEquals(2, csvtest.rejected)
+
+  def testSniff(self):
+    register(self.schema)
+    out = file(self.OUTPUT, 'w')
+    out.write("a, B,C\n")
+    out.close()
+    self.assert_(sniff(self.OUTPUT) is self.schema)
+
+class TestParallelCSVFile(unittest.TestCase):
+
+  def setUp(self):
+    self.OUTPUT = "./testdata/%s-testparallel.csv" % time.strftime("%Y-%m-%d_%H%M%S", time.localtime())
+    out = file(self.OUTPUT, 'w')
+    out.write("a,b,c\n")
+    for i in range(500):
+      out.write('%d,"line\nbreak, and ""quotes""",x\n' % i)
+      out.write("%d,plain,y\n" % i)
+    out.write("bad,line\n")
+    out.close()
+
+  def tearDown(self):
+    if os.path.exists(self.OUTPUT):
+      os.unlink(self.OUTPUT)
+
+  def testSameAsCSVFile(self):
+    get = operator.attrgetter('a', 'b', 'c')
+    serial = [get(e) for e in CSVFile(self.OUTPUT, Dummy)]
+    for processes in (1, 2):
+      parallel = ParallelCSVFile(self.OUTPUT, Dummy, ('a', 'b', 'c'), processes, chunk_size=100)
+      self.assertEquals(serial, list(parallel))
+      self.assertEquals(1, parallel.rejected)
+
+  def testResume(self):
+    serial = CSVFile(self.OUTPUT, Dummy)
+    for i in range(301):
+      serial.next()
+    (offset, lineno) = serial.position()
+    rest = [e.a for e in serial]
+
+    parallel = ParallelCSVFile(self.OUTPUT, Dummy, ('a',), chunk_size=100)
+    parallel.seek(offset, lineno)
+    self.assertEquals(rest, [row[0] for row in parallel])
+    self.assertEquals(serial.position(), parallel.position())
+
+  def testWindow(self):
+    class Result(object):
+      def __init__(self, value):
+        self.get = lambda: value
+    class Pool(object):
+      "Hands back the job itself as its result, and counts the jobs."
+      started = 0
+      def apply_async(self, function, args):
+        self.started += 1
+        return Result(args[0])
+    pool = Pool()
+    parallel = ParallelCSVFile(self.OUTPUT, Dummy, ('a',), 2)
+    results = parallel._window(pool, range(20))
+    self.assertEquals(0, results.next())
+    self.assertEquals(2 * ParallelCSVFile.WINDOW, pool.started)
+    self.assertEquals(range(1, 20), list(results))
+
+  def testRangesEndOnLines(self):
+    parallel = ParallelCSVFile(self.OUTPUT, Dummy, ('a',), chunk_size=100)
+    data = file(self.OUTPUT).read()
+    ranges = parallel._ranges()
+    self.assertEquals(len(data), ranges[-1][1])
+    for (start, stop) in ranges:
+      self.assertEquals("\n", data[stop - 1])
+      self.assertEquals(0, data[start:stop].count('"') % 2)
+
 
 if __name__ == "__main__":
   logging.basicConfig(level=logging.ERROR,format='%(asctime)s %(levelname)s %(message)s')
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+instrument.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+import time
+import unittest
+
+try:
+  import json
+except ImportError:
+  import simplejson as json  # Python 2.5
+
+log = logging.getLogger("instrument")
+
+class Profile(object):
+  """
+    Wall time, calls and rows per stage of a run, and the SQL statements
+    run in each stage. Stages are timed with start() and stop() of this
+    module and can be nested, a stage is known by its path from the
+    outermost one, e.g. "map CSVDBMapper;commit". Every thread has its own
+    stages, so the reading threads of pipeline.py can be timed as well.
+    @param slowest is the number of statements in the report
+  """
+
+  def __init__(self, slowest=10):
+    self.slowest = slowest
+    self.started = time.time()
+    self.stages = {}      # Path -> [seconds, calls, rows, statements]
+    self.statements = {}  # SQL -> [executions, seconds, slowest execution]
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.dialect = None
+    self.executes = None
+
+  def _stack(self):
+    stack = getattr(self.local, 'stack', None)
+    if stack is None:
+      stack = self.local.stack = []
+    return stack
+
+  def start(self, stage):
+    stack = self._stack()
+    stack.append(stage)
+    return (len(stack), time.time())
+
+  def stop(self, token, rows=0):
+    (depth, start) = token
+    seconds = time.time() - start
+    stack = self._stack()
+    path = ";".join(stack[:depth])
+    # Stages that were left by an exception end here as well
+    del stack[depth - 1:]
+    self.lock.acquire()
+    try:
+      stage = self.stages.setdefault(path, [0.0, 0, 0, 0])
+      stage[0] += seconds
+      stage[1] += 1
+      stage[2] += rows
+    finally:
+      self.lock.release()
+
+  def attach(self, engine):
+    "Time every statement that engine runs, until detach()."
+    self.dialect = engine.dialect
+    self.executes = (self.dialect.do_execute, self.dialect.do_executemany)
+    self.dialect.do_execute = self._timed(self.executes[0])
+    self.dialect.do_executemany = self._timed(self.executes[1])
+
+  def detach(self):
+    if self.dialect is not None:
+      (self.dialect.do_execute, self.dialect.do_executemany) = self.executes
+      self.dialect = None
+
+  def _timed(self, execute):
+    def timed(cursor, statement, parameters, context=None):
+      start = time.time()
+      try:
+        return execute(cursor, statement, parameters, context)
+      finally:
+        self._statement(statement, time.time() - start)
+    return timed
+
+  def _statement(self, statement, seconds):
+    path = ";".join(self._stack()) or "(no stage)"
+    self.lock.acquire()
+    try:
+      stats = self.statements.setdefault(statement, [0, 0.0, 0.0])
+      stats[0] += 1
+      stats[1] += seconds
+      stats[2] = max(stats[2], seconds)
+      self.stages.setdefault(path, [0.0, 0, 0, 0])[3] += 1
+    finally:
+      self.lock.release()
+
+  def report(self):
+    """
+      The profile as a dict that can be written as JSON. The statements
+      that took the most time in total come first, so one that is run once
+      per row stands out as much as one that is slow.
+    """
+    stages = {}
+    for path, (seconds, calls, rows, statements) in self.stages.items():
+      stage = { 'seconds': seconds, 'calls': calls, 'statements': statements }
+      if rows > 0:
+        stage['rows'] = rows
+        stage['rows_per_second'] = rows / max(seconds, 0.000001)
+      stages[path] = stage
+    statements = [(seconds, sql, executions, slowest)
+                  for sql, (executions, seconds, slowest) in self.statements.items()]
+    statements.sort(reverse=True)
+    return { 'seconds': time.time() - self.started,
+             'statements': sum([stats[0] for stats in self.statements.values()]),
+             'statement_seconds': sum([stats[1] for stats in self.statements.values()]),
+             'stages': stages,
+             'slowest': [{ 'sql': sql, 'executions': executions, 'seconds': seconds, 'slowest': slowest }
+                         for (seconds, sql, executions, slowest) in statements[:self.slowest]] }
+
+  def folded(self):
+    """
+      The stages in the folded format of flamegraph.pl: a line per stage
+      with its path and the microseconds spent in it and not in a stage
+      inside it.
+    """
+    own = dict([(path, stage[0]) for path, stage in self.stages.items() if stage[1] > 0])
+    for path, stage in self.stages.items():
+      parent = path.rsplit(";", 1)[0]
+      if parent != path and own.has_key(parent):
+        own[parent] -= stage[0]
+    return "".join(["%s %d\n" % (path, max(0, int(seconds * 1000000)))
+                    for path, seconds in sorted(own.items())])
+
+  def write(self, path):
+    "Write the profile to path, folded if it ends with .folded, else as JSON."
+    out = file(path, 'w')
+    try:
+      if path.endswith(".folded"):
+        out.write(self.folded())
+      else:
+        json.dump(self.report(), out, indent=2, sort_keys=True)
+    finally:
+      out.close()
+
+_profile = None  # See enable()
+
+def enable(engine=None, slowest=10):
+  "Start profiling, and time the statements of engine if one is given."
+  global _profile
+  _profile = Profile(slowest)
+  if engine is not None:
+    _profile.attach(engine)
+  return _profile
+
+def disable():
+  "Stop profiling. Returns the Profile."
+  global _profile
+  profile = _profile
+  _profile = None
+  if profile is not None:
+    profile.detach()
+  return profile
+
+def start(stage):
+  "Start timing stage. Returns what stop() takes, None if not profiling."
+  if _profile is None:
+    return None
+  return _profile.start(stage)
+
+def stop(token, rows=0):
+  "Stop timing the stage that start() gave token for, it handled rows rows."
+  if token is not None and _profile is not None:
+    _profile.stop(token, rows)
+
+def timed(stage, iterable, rows=len):
+  """
+    Iterate over iterable, timing how long it takes to get each item as
+    stage, which handled rows(item) rows.
+  """
+  iterator = iter(iterable)
+  while True:
+    token = start(stage)
+    try:
+      item = iterator.next()
+    except StopIteration:
+      stop(token)
+      return
+    stop(token, rows(item))
+    yield item
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestProfile(unittest.TestCase):
+
+  def tearDown(self):
+    disable()
+
+  def testDisabled(self):
+    self.assertEquals(None, start("stage"))
+    stop(None, 10)
+
+  def testStages(self):
+    profile = enable()
+    outer = start("map")
+    for i in range(3):
+      inner = start("commit")
+      stop(inner, 10)
+    stop(outer, 30)
+    broken = start("map")
+    start("left by an exception")
+    stop(broken)
+    report = profile.report()
+    self.assertEquals(set(["map", "map;commit"]), set(report['stages'].keys()))
+    self.assertEquals((2, 30), (report['stages']['map']['calls'], report['stages']['map']['rows']))
+    self.assertEquals((3, 30), (report['stages']['map;commit']['calls'], report['stages']['map;commit']['rows']))
+    self.assertEquals(["map", "map;commit"], [line.split(" ")[0] for line in profile.folded().splitlines()])
+
+  def testTimed(self):
+    profile = enable()
+    self.assertEquals([[1], [2, 3]], list(timed("read", [[1], [2, 3]])))
+    self.assertEquals((3, 3), (profile.report()['stages']['read']['calls'], profile.report()['stages']['read']['rows']))
+
+  def testStatements(self):
+    profile = enable()
+    execute = profile._timed(lambda cursor, statement, parameters, context=None: None)
+    token = start("report")
+    for i in range(5):
+      execute(None, "SELECT 1", ())
+    execute(None, "SELECT 2", ())
+    stop(token)
+    report = profile.report()
+    self.assertEquals(6, report['statements'])
+    self.assertEquals(6, report['stages']['report']['statements'])
+    self.assertEquals(["SELECT 1", "SELECT 2"], sorted([stats['sql'] for stats in report['slowest']]))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -21,158 +21,681 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
+import itertools
 import logging
+import operator
+import os
+import tempfile
 import time
+import unittest
 
+from sqlalchemy import and_, bindparam, select
+
+import instrument
 from config import cfg
-from csvparser import CSVFile
+from csvparser import CSVFile, ParallelCSVFile
+from pipeline import ReadAhead
 from model import *
+from model import _dates
 
 log = logging.getLogger("mapper")
 
+# Pragmas applied to SQLite while bulk loading. The values they had are
+# put back afterwards. The rollback journal is left alone and syncing is
+# only relaxed to NORMAL, so a load that is killed leaves the DB at its
+# last commit, which is what --resume continues from.
+BULK_PRAGMAS = [("synchronous", "NORMAL"),
+                ("temp_store", "MEMORY"),
+                ("cache_size", "100000")]
+
+class IdentityMap(object):
+  """
+    Keeps every Customer, Project, Employee and Office of the DB in memory
+    during an ingest so that a row can be mapped without any lookup queries.
+    Projects are keyed by (customer name, project name) and the
+    project/employee relationships are kept as a set of (project id,
+    employee name) pairs. Everything is preloaded with one query per table
+    and new entities are added with the get_or_create methods.
+  """
+
+  def __init__(self):
+    self.customers = {}
+    self.projects = {}
+    self.employees = {}
+    self.offices = {}
+    self.members = set()
+    self.member_table = Project.mapper.get_property('employees').secondary
+    self.member_columns = {}
+    for fk in self.member_table.foreign_keys:
+      self.member_columns[fk.column.table] = fk.parent.name
+    stage = instrument.start("preload")
+    self._preload()
+    instrument.stop(stage)
+
+  def _preload(self):
+    for customer in Customer.query.all():
+      self.customers[customer.name] = customer
+    for project in Project.query.all():
+      if project.customer is not None:
+        self.projects[(project.customer.name, project.name)] = project
+    for employee in Employee.query.all():
+      self.employees[employee.name] = employee
+    for office in Office.query.all():
+      self.offices[office.name] = office
+    project_col = self.member_table.c[self.member_columns[Project.table]]
+    employee_col = self.member_table.c[self.member_columns[Employee.table]]
+    rows = session.execute(select([project_col, employee_col]), mapper=Project)
+    for row in rows:
+      self.members.add((row[0], row[1]))
+
+  def customer(self, name):
+    customer = self.customers.get(name)
+    if customer is None:
+      customer = Customer(name=name)
+      self.customers[name] = customer
+    return customer
+
+  def project(self, customer, name):
+    "Return the project of customer, new projects are flushed to get an id."
+    key = (customer.name, name)
+    project = self.projects.get(key)
+    if project is None:
+      project = Project(name=name)
+      project.customer = customer
+      session.flush()
+      self.projects[key] = project
+    return project
+
+  def employee(self, name):
+    employee = self.employees.get(name)
+    if employee is None:
+      employee = Employee(name=name)
+      self.employees[name] = employee
+    return employee
+
+  def office(self, name):
+    office = self.offices.get(name)
+    if office is None:
+      office = Office(name=name)
+      self.offices[name] = office
+    return office
+
+  def add_member(self, project, employee):
+    """
+      Return the row that relates employee to project, or None if they are
+      already related.
+    """
+    key = (project.id, employee.name)
+    if key in self.members:
+      return None
+    self.members.add(key)
+    return { self.member_columns[Project.table]: project.id,
+             self.member_columns[Employee.table]: employee.name }
+
+
 class Mapper(object):
-  
-  def __init__(self, csvfile):
-    pass
-  
+  """
+    Base class for the mappers. Rows are queued with _insert() and written
+    with one executemany per table and one commit for every batch_size
+    entries, instead of a commit per row. Each commit also stores how far
+    the file has been read in a Checkpoint, so a run that dies can be
+    resumed after the last commit.
+    @param bulk is True to load in large transactions with the SQLite bulk
+           pragmas applied, False to commit every row (cfg['bulk_load'])
+    @param batch_size is the number of entries per transaction
+           (cfg['batch_size'])
+    @param resume is True to continue at the checkpoint of csvfile
+    Entries come from _entries(), or from self.reader when the parsing is
+    done by another thread (see pipeline.py), which hands them over
+    chunk_size at a time. A mapper that is not part of a Pipeline starts
+    a ReadAhead of its own if read_ahead is True (cfg['read_ahead']), so
+    the file is parsed while the DB is written.
+  """
+
+  chunk_size = 1000
+
+  def __init__(self, csvfile, bulk=None, batch_size=None, resume=False):
+    if bulk is None:
+      bulk = cfg.get('bulk_load', True)
+    if batch_size is None:
+      batch_size = cfg.get('batch_size', 10000)
+    self.bulk = bulk
+    self.batch_size = 1
+    if bulk:
+      self.batch_size = max(1, int(batch_size))
+    self.source = unicode(os.path.abspath(csvfile), 'utf-8')
+    self.resume = resume
+    self.checkpoint = None
+    self.reader = None
+    self.read_ahead = cfg.get('read_ahead', True)
+    self.pragmas = []  # (name, value before _begin())
+    self.pending = {}
+    self.queued = 0
+    self.identities = None
+    self.done = False
+
   def map(self):
     pass
-    
-    
+
+  def prepare(self):
+    """
+      Load the checkpoint of the file and move to it when resuming. Has to
+      be done before anyone starts reading the entries.
+    """
+    if self.checkpoint is None:
+      self.checkpoint = Checkpoint.get(self.source)
+      if self.checkpoint is None:
+        (offset, lineno) = self.csv.position()
+        self.checkpoint = Checkpoint(source=self.source, offset=offset, lineno=lineno)
+      elif self.resume:
+        log.info("Resuming %s at line %d" % (self.source, self.checkpoint.lineno))
+        self.csv.seek(self.checkpoint.offset, self.checkpoint.lineno)
+
+  def _entries(self):
+    "Iterate over the parsed entries of the file."
+    return iter(self.csv)
+
+  def _rows(self):
+    "The entries to map, from self.reader if there is one."
+    if self.reader is None and self.read_ahead:
+      self.reader = ReadAhead(self, self.chunk_size).start()
+    if self.reader is not None:
+      return iter(self.reader)
+    return self._entries()
+
+  def _position(self):
+    "The position in the file after the last entry from _rows()."
+    if self.reader is not None:
+      return self.reader.position()
+    return self.csv.position()
+
+  def _stop_reading(self):
+    """
+      Stop the thread that reads the entries, if there is one, and wait for
+      it. For the finally of map(), so a writer that fails does not leave
+      the reader behind.
+    """
+    if self.reader is not None:
+      self.reader.stop()
+      self.reader.join()
+
+  def _begin(self):
+    "Get ready to map. Has to be followed by _restore(), in a finally."
+    self.prepare()
+    if self.bulk and self._is_sqlite():
+      # SQLite only changes these outside of a transaction
+      session.commit()
+      for name, value in BULK_PRAGMAS:
+        old = session.execute("PRAGMA %s" % name, mapper=Task).fetchone()[0]
+        self.pragmas.append((name, old))
+        session.execute("PRAGMA %s = %s" % (name, value), mapper=Task)
+    self.identities = IdentityMap()
+
+  def _end(self):
+    "Write what is left of the last batch."
+    self._flush()
+
+  def _restore(self):
+    """
+      Put back the pragmas that _begin() changed. A batch that was not
+      committed, because mapping failed, is rolled back first.
+    """
+    if len(self.pragmas) > 0:
+      session.rollback()
+      for name, value in self.pragmas:
+        session.execute("PRAGMA %s = %s" % (name, value), mapper=Task)
+      self.pragmas = []
+
+  def _insert(self, table, row):
+    "Queue a row for table."
+    if not self.pending.has_key(table):
+      self.pending[table] = []
+    self.pending[table].append(row)
+
+  def _row_done(self, count=1):
+    "Called after each entry, commits the batch when it is full."
+    self.queued += count
+    if self.queued >= self.batch_size:
+      self._flush()
+
+  def _flush(self):
+    "Write all queued rows and the checkpoint and commit them in one transaction."
+    (self.checkpoint.offset, self.checkpoint.lineno) = self._position()
+    stage = instrument.start("write")
+    session.flush()
+    written = 0
+    for table, rows in self.pending.items():
+      if len(rows) > 0:
+        session.execute(table.insert(), rows)
+        written += len(rows)
+    instrument.stop(stage, written)
+    self.pending = {}
+    self.queued = 0
+    stage = instrument.start("commit")
+    session.commit()
+    instrument.stop(stage)
+
+  def _is_sqlite(self):
+    return metadata.bind.name == 'sqlite'
+
+
 class CSVDBMapper(Mapper):
   """
     This is were all the magic happends. All the entries in the csvfile
     parameter is read and fed to the database.
+    @param processes is the number of processes that parse the file, 1 to
+           parse it in this process and None for one per CPU
+    @param incremental is True to skip entries whose digest is already in
+           the DB, so overlapping exports can be loaded again
+           (cfg['incremental'])
+    @param columnar is True to parse the file into a TimeEntryBatch per
+           batch_size entries and look the customers, projects and
+           employees up once per batch (cfg['columnar']), only when the
+           file is parsed in one process
   """
-  def __init__(self, csvfile):
-    self.csv = CSVFile(csvfile, TimeEntry)
-    self.done = False
+
+  # The TimeEntry attributes that end up in the DB
+  FIELDS = ('date', 'customer', 'project', 'task', 'hours', 'first_name', 'last_name', 'billable', 'digest')
+
+  # SQLite allows at most 999 variables in a statement, so IN clauses
+  # get at most this many values
+  PER_QUERY = 500
+
+  def __init__(self, csvfile, bulk=None, batch_size=None, resume=False, processes=1, incremental=None, columnar=None):
+    Mapper.__init__(self, csvfile, bulk, batch_size, resume)
+    if incremental is None:
+      incremental = cfg.get('incremental', True)
+    if columnar is None:
+      columnar = cfg.get('columnar', False)
+    self.incremental = incremental
+    self.columnar = columnar and processes == 1
+    if self.columnar:
+      # Every entry is a whole batch already
+      self.chunk_size = 1
+    self.path = csvfile
+    self.occurrences = {}     # Digest -> entries with it so far in the file
+    self.skipped = 0
+    self.rollup = set()       # DailyHours keys, see _rollup()
+    self.rollup_dates = set()
+    self.years = set()        # Years in Day, see _flush()
+    if processes == 1:
+      self.csv = CSVFile(csvfile, TimeEntry)
+    else:
+      self.csv = ParallelCSVFile(csvfile, TimeEntry, CSVDBMapper.FIELDS, processes)
+
+  def prepare(self):
+    if self.checkpoint is None:
+      Mapper.prepare(self)
+      if self.resume:
+        self._count_occurrences(self.checkpoint.offset)
+
+  def _count_occurrences(self, offset):
+    """
+      Count the digests of the entries before offset, the part of the file
+      an earlier run has committed, so the identical entries after it are
+      numbered on from there and not taken for those already in the DB.
+    """
+    csv = CSVFile(self.path, TimeEntry)
+    for entry in csv:
+      if csv.position()[0] > offset:
+        break
+      self.occurrences[entry.digest] = self.occurrences.get(entry.digest, 0) + 1
+
+  def _flush(self):
+    if self.pending.has_key(Task.table):
+      if self.incremental:
+        stage = instrument.start("dedupe")
+        rows = len(self.pending[Task.table])
+        self.pending[Task.table] = self._new_tasks(self.pending[Task.table])
+        instrument.stop(stage, rows)
+      stage = instrument.start("rollup")
+      self._rollup(self.pending[Task.table])
+      instrument.stop(stage, len(self.pending[Task.table]))
+      # The reports join on Day, so it needs the years of the tasks
+      years = set([str(row['date'])[:4] for row in self.pending[Task.table]]) - self.years
+      if len(years) > 0:
+        Day.cover(min(years), max(years))
+        self.years.update(years)
+      # Reports of these months have to be generated again
+      for period in set([str(row['date'])[:7] for row in self.pending[Task.table]]):
+        DataVersion.bump(unicode(period))
+    Mapper._flush(self)
+
+  def _rollup(self, rows):
+    """
+      Add the hours of the task rows to DailyHours. Sums that are already
+      there are updated right away and new ones are queued, so either way
+      they are committed together with the tasks. The sums of a date are
+      read once per ingest and kept in self.rollup.
+    """
+    table = DailyHours.table
+    sums = {}
+    keys = []  # In the order they first appear, like the tasks
+    for row in rows:
+      key = (str(row['date']), row['employee_name'], row['project_id'], row['name'], bool(row['billable']))
+      if not sums.has_key(key):
+        sums[key] = 0.0
+        keys.append(key)
+      sums[key] += row['hours']
+
+    dates = list(set([key[0] for key in keys]) - self.rollup_dates)
+    columns = [table.c.date, table.c.employee_name, table.c.project_id, table.c.task, table.c.billable]
+    for i in range(0, len(dates), CSVDBMapper.PER_QUERY):
+      query = select(columns, table.c.date.in_(dates[i:i + CSVDBMapper.PER_QUERY]))
+      for row in session.execute(query, mapper=DailyHours):
+        self.rollup.add((str(row[0]), row[1], row[2], row[3], bool(row[4])))
+    self.rollup_dates.update(dates)
+
+    updates = []
+    for key in keys:
+      if key in self.rollup:
+        updates.append({ 'key_date': key[0],
+                         'key_employee': key[1],
+                         'key_project': key[2],
+                         'key_task': key[3],
+                         'key_billable': key[4],
+                         'delta': sums[key] })
+      else:
+        self.rollup.add(key)
+        self._insert(table, { 'date': key[0],
+                              'employee_name': key[1],
+                              'project_id': key[2],
+                              'task': key[3],
+                              'billable': key[4],
+                              'hours': sums[key] })
+    if len(updates) > 0:
+      update = table.update(and_(table.c.date == bindparam('key_date'),
+                                 table.c.employee_name == bindparam('key_employee'),
+                                 table.c.project_id == bindparam('key_project'),
+                                 table.c.task == bindparam('key_task'),
+                                 table.c.billable == bindparam('key_billable')),
+                            values={ table.c.hours: table.c.hours + bindparam('delta') })
+      session.execute(update, updates)
+
+  def _new_tasks(self, rows):
+    "Return the task rows whose digest is not in the DB, one query per 500 rows."
+    digests = [row['digest'] for row in rows]
+    loaded = set()
+    column = Task.table.c.digest
+    for i in range(0, len(digests), CSVDBMapper.PER_QUERY):
+      chunk = digests[i:i + CSVDBMapper.PER_QUERY]
+      for row in session.execute(select([column], column.in_(chunk)), mapper=Task):
+        loaded.add(row[0])
+    if len(loaded) == 0:
+      return rows
+    self.skipped += len(loaded)
+    return [row for row in rows if not row['digest'] in loaded]
+
+  def _entries(self):
+    "Yield the FIELDS of every entry as a tuple, or TimeEntryBatches."
+    if self.columnar:
+      return self.csv.batches(TimeEntryBatch, self.batch_size)
+    elif isinstance(self.csv, ParallelCSVFile):
+      return iter(self.csv)
+    else:
+      return itertools.imap(operator.attrgetter(*CSVDBMapper.FIELDS), self.csv)
 
   def map(self):
     if not self.done:
       ts = time.time()
+      stage = instrument.start("map %s" % self.__class__.__name__)
       entries = 0
-      for entry in self.csv:
-        log.debug("Updating record (%d) %s" % (entries,entry))
-
-        # 1) Check if the customer exists in DB, else create.
-        q = Customer.query.filter_by(name=entry.customer)
-        customer = q.first()  # If there should be multiple names, we ignore them
-        if customer is None:
-          customer = Customer(name=entry.customer)
+      self._begin()
+      try:
+        for entry in self._rows():
+          if self.columnar:
+            entries += self._map_batch(entry)
+            continue
+          log.debug("Updating record (%d) %s" % (entries,entry))
+          (date, customer_str, project_str, task, hours, first_name, last_name, billable, digest) = entry
+
+          # 1) Get the customer, created if it is not in the DB.
+          lookup = instrument.start("lookup")
+          customer = self.identities.customer(customer_str)
           
-        # 2) Check if the project exists in DB, else create.
-        q = Project.query.filter_by(name=entry.project)
-        q = q.filter(Project.customer.has(name=customer.name))
-        project = q.first()  # If there should be multiple names, we ignore them
-        if project is None:
-          project = Project(name=entry.project)
-
-        # 2.5) Set up relationship between customer and project
-        customer.projects.append(project)
-
-        # 3) Check if the employee exists in DB, else create.
-        employee_str = "%s %s" % (entry.first_name, entry.last_name)
-        q = Employee.query.filter_by(name=employee_str)
-        employee = q.first()
-        if employee is None:
-          employee = Employee(name=employee_str)
-
-        # 3.5) Set up relationsship between employee and project
-        if not employee in project.employees:
-          project.employees.append(employee)
-        if not project in employee.projects:
-          employee.projects.append(project)
+          # 2) Get the project of that customer, created if it is not in the DB.
+          project = self.identities.project(customer, project_str)
+
+          # 3) Get the employee, created if it is not in the DB.
+          employee_str = "%s %s" % (first_name, last_name)
+          employee = self.identities.employee(employee_str)
+
+          # 3.5) Set up relationsship between employee and project
+          member = self.identities.add_member(project, employee)
+          if member is not None:
+            self._insert(self.identities.member_table, member)
+          instrument.stop(lookup, 1)
         
-        # 4) Skip check exists since it takes to much time. Just add to DB
-        task = Task(name=entry.task,date=entry.date,hours=entry.hours,billable=entry.billable)
-        task.employee = employee
-        task.project = project
-        entries+=1
- 
-        # 5) Commit and we are ready for a new one!
-        #session.flush()
-        session.commit()
+          # 4) Identical entries in one file are all kept, the second one
+          #    and onwards get the number of the occurrence in their digest.
+          count = self.occurrences.get(digest, 0) + 1
+          self.occurrences[digest] = count
+          if count > 1:
+            digest = u"%s-%d" % (digest, count)
+
+          # 5) Just queue it, it is written with the rest of the batch. Rows
+          #    that are already in the DB are dropped in _flush().
+          self._insert(Task.table, { 'name': task,
+                                     'date': _dates[date],
+                                     'hours': hours,
+                                     'billable': billable,
+                                     'digest': digest,
+                                     'employee_name': employee.name,
+                                     'project_id': project.id })
+          entries+=1
+          self._row_done()
 
+        # 6) Commit what is left of the last batch and we are done!
+        self._end()
+      finally:
+        self._stop_reading()
+        self._restore()
+      instrument.stop(stage, entries)
       
-      log.info("It took %d seconds to update %d entries." % (time.time()-ts, entries))
-      done = True
+      log.info("It took %d seconds to update %d entries, %d were already in the DB." % (time.time()-ts, entries, self.skipped))
+      self.done = True
     else:
       pass                     
 
+  def _map_batch(self, batch):
+    """
+      Queue the rows of a TimeEntryBatch the same way map() does with single
+      entries, but with one lookup per distinct customer, project and
+      employee of the batch. Returns the number of entries.
+    """
+    customers = batch.customer.tolist()
+    project_codes = batch.project.tolist()
+    employee_codes = batch.employee.tolist()
+    codes = batch.codes
+
+    # 1-3) Get the customers, projects and employees of the batch
+    stage = instrument.start("lookup")
+    projects = {}
+    for key in set(zip(customers, project_codes)):
+      customer = self.identities.customer(codes['customer'].values[key[0]])
+      projects[key] = self.identities.project(customer, codes['project'].values[key[1]])
+    employees = {}
+    for code in set(employee_codes):
+      employees[code] = self.identities.employee(u"%s %s" % codes['employee'].values[code])
+
+    # 3.5) Set up the relationships between employees and projects
+    project_keys = zip(customers, project_codes)
+    for (key, code) in set(zip(project_keys, employee_codes)):
+      member = self.identities.add_member(projects[key], employees[code])
+      if member is not None:
+        self._insert(self.identities.member_table, member)
+    instrument.stop(stage, len(batch))
+
+    # 4-5) Number repeated digests and queue the tasks
+    rows = zip(batch.values('date'), batch.values('task'), batch.hours.tolist(),
+               batch.values('billable'), batch.digests(), employee_codes, project_keys)
+    for (date, task, hours, billable, digest, code, key) in rows:
+      count = self.occurrences.get(digest, 0) + 1
+      self.occurrences[digest] = count
+      if count > 1:
+        digest = u"%s-%d" % (digest, count)
+      self._insert(Task.table, { 'name': task,
+                                 'date': _dates[date],
+                                 'hours': hours,
+                                 'billable': billable,
+                                 'digest': digest,
+                                 'employee_name': employees[code].name,
+                                 'project_id': projects[key].id })
+    self._row_done(len(batch))
+    return len(batch)
+
 class POMapper(Mapper):
 
-  def __init__(self, csvfile):
+  def __init__(self, csvfile, bulk=None, batch_size=None, resume=False):
+    Mapper.__init__(self, csvfile, bulk, batch_size, resume)
     self.csv = CSVFile(csvfile, POEntry)
-    self.done = False
   
   def map(self):
     if not self.done:
       ts = time.time()
+      stage = instrument.start("map %s" % self.__class__.__name__)
       entries = 0
-      for entry in self.csv:
-        log.debug("Updating record (%d) %s" % (entries,entry))
-
-        # 1) Check if the employee exists in DB, else create.
-        employee_str = entry.employee
-        q = Employee.query.filter_by(name=employee_str)
-        employee = q.first()
-        if employee is None:
-          employee = Employee(name=employee_str)
-        
-        # 2) Create Purchase order
-        po = PurchaseOrder(number=entry.number,start=entry.start,stop=entry.stop,price=entry.price,customer=entry.customer,reference=entry.reference)
-        po.employee = employee
-        entries+=1
-        
-        # 3) Set up relationship between employee and PO
-        employee.pos.append(po)
+      self._begin()
+      try:
+        DataVersion.bump(DataVersion.ALL)  # Every report shows these
+        for entry in self._rows():
+          log.debug("Updating record (%d) %s" % (entries,entry))
+
+          # 1) Get the employee, created if it is not in the DB.
+          employee = self.identities.employee(entry.employee)
         
-        session.commit()
+          # 2) Create Purchase order, related to the employee by name
+          self._insert(PurchaseOrder.table, { 'number': entry.number,
+                                              'start': _dates[entry.start],
+                                              'stop': _dates[entry.stop],
+                                              'price': entry.price,
+                                              'customer': entry.customer,
+                                              'reference': entry.reference,
+                                              'employee_name': employee.name })
+          entries+=1
+          self._row_done()
 
+        self._end()
+      finally:
+        self._stop_reading()
+        self._restore()
+      instrument.stop(stage, entries)
       
       log.info("It took %d seconds to update %d entries." % (time.time()-ts, entries))
-      done = True
+      self.done = True
     else:
       pass
     
   
 class CWMapper(Mapper):
   
-  def __init__(self, csvfile):
+  def __init__(self, csvfile, bulk=None, batch_size=None, resume=False):
+    Mapper.__init__(self, csvfile, bulk, batch_size, resume)
     self.csv = CSVFile(csvfile, CWEntry)
-    self.done = False
     
   def map(self):
     if not self.done:
       ts = time.time()
+      stage = instrument.start("map %s" % self.__class__.__name__)
       entries = 0
-      for entry in self.csv:
-        log.debug("Updating record (%d) %s" % (entries,entry))
-
-        # 1) Check if the employee exists in DB, else create.
-        employee_str = entry.employee
-        q = Employee.query.filter_by(name=employee_str)
-        employee = q.first()
-        if employee is None:
-          employee = Employee(name=employee_str)
-        
-        # 2) Update employee number
-        employee.number = entry.number
+      self._begin()
+      try:
+        DataVersion.bump(DataVersion.ALL)  # Every report shows these
+        for entry in self._rows():
+          log.debug("Updating record (%d) %s" % (entries,entry))
+
+          # 1) Get the employee, created if it is not in the DB.
+          employee = self.identities.employee(entry.employee)
         
-        # 3) Check if office exists in DB, else create.
-        q = Office.query.filter_by(name=entry.office)
-        office = q.first()
-        if office is None:
-          office = Office(name=entry.office)
+          # 2) Update employee number
+          employee.number = entry.number
         
-        office.employees.append(employee)
-        employee.office = office
+          # 3) Get the office, created if it is not in the DB.
+          office = self.identities.office(entry.office)
+          employee.office = office
+
+          entries+=1
+          self._row_done()
 
-        entries+=1
-        session.commit()
+        self._end()
+      finally:
+        self._stop_reading()
+        self._restore()
+      instrument.stop(stage, entries)
 
       log.info("It took %d seconds to update %d entries." % (time.time()-ts, entries))
-      done = True
+      self.done = True
     else:
-      pass   
\ No newline at end of file
+      pass
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestCSVDBMapper(unittest.TestCase):
+
+  ROW = "2009-05-04,Customer,Project,,Development,,%s,Emil,Erlandsson,billable,employee,yes,0.0,0.0,Dev\n"
+
+  def setUp(self):
+    # A DB of its own, not the one of config.py
+    session.close()
+    (fd, self.db) = tempfile.mkstemp()
+    os.close(fd)
+    self.bind = metadata.bind
+    metadata.bind = create_bind("sqlite:///%s" % self.db)
+    metadata.create_all()
+    (fd, self.path) = tempfile.mkstemp()
+    out = os.fdopen(fd, 'w')
+    out.write("Date,Client,Project,Project Code,Task,Notes,Hours,First Name,Last Name,Billable?,Employee?,Approved?,Hourly Rate,Cost,Department\n")
+    for hours in ["1", "1", "3", "1", "1"]:
+      out.write(TestCSVDBMapper.ROW % hours)
+    out.close()
+
+  def tearDown(self):
+    session.close()
+    metadata.bind = self.bind
+    os.unlink(self.db)
+    os.unlink(self.path)
+
+  def _hours(self):
+    return session.execute(select([func.count(Task.table.c.id), func.sum(Task.table.c.hours)]), mapper=Task).fetchone()
+
+  def _resume(self, columnar):
+    # Killed after the first batch, the two first identical entries
+    mapper = CSVDBMapper(self.path, batch_size=2, columnar=columnar)
+    flush = mapper._flush
+    def interrupted():
+      if mapper.checkpoint.lineno > 0:
+        raise KeyboardInterrupt()
+      flush()
+    mapper._flush = interrupted
+    self.assertRaises(KeyboardInterrupt, mapper.map)
+    self.assertEquals((2, 2.0), tuple(self._hours()))
+
+    CSVDBMapper(self.path, batch_size=2, resume=True, columnar=columnar).map()
+    self.assertEquals((5, 7.0), tuple(self._hours()))
+
+  def testResumeRepeatedEntries(self):
+    self._resume(False)
+
+  def testResumeRepeatedBatches(self):
+    self._resume(True)
+
+  def testDays(self):
+    CSVDBMapper(self.path, batch_size=2).map()
+    self.assertEquals(365, session.execute(select([func.count(Day.table.c.date)]), mapper=Day).scalar())
+
+  def testWriterFails(self):
+    mapper = CSVDBMapper(self.path, batch_size=1)
+    mapper.read_ahead = True
+    mapper.chunk_size = 1
+    def failed():
+      raise IOError("disk full")
+    mapper._flush = failed
+    self.assertRaises(IOError, mapper.map)
+    self.assert_(mapper.reader.stopped)
+    self.assert_(not mapper.reader.thread.isAlive())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -23,9 +23,26 @@ along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from elixir import *
+from sqlalchemy import and_, bindparam, create_engine, func, select, Index, MetaData, Table, UniqueConstraint
+from sqlalchemy.exceptions import DBAPIError
+from sqlalchemy.interfaces import PoolListener
+import _strptime  # Imported by the first strptime() otherwise, which is not thread safe
+import array
+import datetime
+import hashlib
+import logging
+import os
+import tempfile
 import unittest
 
-from csvparser import CSVFile
+try:
+  import numpy
+except ImportError:
+  numpy = None  # TimeEntryBatch keeps its columns in array.array
+
+from csvparser import CSVFile, Schema, register
+
+log = logging.getLogger("model")
 
 class Customer(Entity):
   name = Field(Unicode(50), unique=True)
@@ -73,31 +90,310 @@ class Task(Entity):
   date = Field(Date())
   hours = Field(Float())
   billable = Field(Boolean())
+  digest = Field(Unicode(40), index=True)  # TimeEntry.digest, see CSVDBMapper
   employee = ManyToOne('Employee')
   project = ManyToOne('Project')
 
   def __repr__(self):
     return '<Task "%s - %s %0.2f hours at %s">' % (self.date, self.employee.name, self.hours,self.name)
   
+class DailyHours(Entity):
+  """
+    The hours of Task summed by date, employee, project, task name and
+    billable. CSVDBMapper keeps it up to date in the same transactions as
+    the tasks, so the reports do not have to scan Task. A DB that was
+    loaded before this table existed is filled in with rebuild().
+  """
+  date = Field(Date(), index=True)
+  task = Field(Unicode(50))
+  billable = Field(Boolean())
+  hours = Field(Float())
+  employee = ManyToOne('Employee')
+  project = ManyToOne('Project')
+  using_table_options(UniqueConstraint('date', 'employee_name', 'project_id', 'task', 'billable'))
+
+  @classmethod
+  def rebuild(cls):
+    "Replace the contents with the sums of every Task."
+    session.execute(cls.table.delete(), mapper=cls)
+    task = Task.table
+    groups = [task.c.date, task.c.employee_name, task.c.project_id, task.c.name, task.c.billable]
+    query = select(groups + [func.sum(task.c.hours)], group_by=groups, order_by=[func.min(task.c.id)])
+    keys = ('date', 'employee_name', 'project_id', 'task', 'billable', 'hours')
+    rows = [dict(zip(keys, row)) for row in session.execute(query, mapper=Task)]
+    if len(rows) > 0:
+      session.execute(cls.table.insert(), rows)
+    DataVersion.bump(DataVersion.ALL)  # The cached reports were made from the old sums
+
+  def __repr__(self):
+    return '<DailyHours "%s - %s %0.2f hours at %s">' % (self.date, self.employee.name, self.hours, self.task)
+
+class Day(Entity):
+  """
+    The date dimension: one row per day of every year there are tasks in,
+    with its month ("YYYY-MM"), ISO week and weekday (Monday is 0), and
+    whether it is a working day. Days in cfg['holidays'] are not. Reports
+    join on it instead of doing the date arithmetic in Python.
+  """
+  date = Field(Date(), primary_key=True)
+  month = Field(Unicode(7), index=True)
+  iso_year = Field(Integer())
+  iso_week = Field(Integer())
+  weekday = Field(Integer())
+  working = Field(Boolean())
+  holiday = Field(Unicode(50))
+
+  @classmethod
+  def cover(cls, first=None, last=None):
+    """
+      Add the years from the year of first to that of last, by default
+      those of the first and last Task, that are not in the table yet.
+    """
+    if first is None or last is None:
+      task = Task.table
+      (first, last) = session.execute(select([func.min(task.c.date), func.max(task.c.date)]), mapper=Task).fetchone()
+      if first is None:
+        return
+    years = set(range(int(str(first)[:4]), int(str(last)[:4]) + 1))
+    done = session.execute(select([func.substr(cls.table.c.date, 1, 4)], distinct=True), mapper=cls)
+    years -= set([int(row[0]) for row in done])
+
+    holidays = {}
+    for date, name in cfg.get('holidays', {}).items():
+      if not isinstance(name, unicode):
+        name = unicode(name, 'utf-8')
+      holidays[_dates[date]] = name
+    rows = []
+    for year in sorted(years):
+      day = datetime.date(year, 1, 1)
+      while day.year == year:
+        (iso_year, iso_week, weekday) = day.isocalendar()
+        rows.append({ 'date': day,
+                      'month': unicode(day.strftime("%Y-%m")),
+                      'iso_year': iso_year,
+                      'iso_week': iso_week,
+                      'weekday': weekday - 1,
+                      'working': weekday < 6 and not holidays.has_key(day),
+                      'holiday': holidays.get(day) })
+        day += datetime.timedelta(days=1)
+    if len(rows) > 0:
+      session.execute(cls.table.insert(), rows)
+
+  @classmethod
+  def rebuild(cls):
+    "Generate the days of every year there are tasks in again, e.g. for new holidays."
+    session.execute(cls.table.delete(), mapper=cls)
+    cls.cover()
+    DataVersion.bump(DataVersion.ALL)  # The working days of every month may have changed
+
+  @classmethod
+  def working_days(cls, period):
+    "The number of working days in the month period, YYYY-MM."
+    query = select([func.count(cls.table.c.date)],
+                   and_(cls.table.c.month == period, cls.table.c.working == True))
+    return session.execute(query, mapper=cls).scalar()
+
+  def __repr__(self):
+    return '<Day "%s">' % self.date
+
+# Indexes for the date range queries of the reports, as (entity, column
+# names). See create_indexes() and check_schema.py.
+INDEXES = [(DailyHours, ('employee_name', 'date')),
+           (Project, ('name',)),
+           (Employee, ('number',)),
+           (PurchaseOrder, ('start', 'stop')),
+           (PurchaseOrder, ('employee_name', 'start'))]
+
+# Indexes that earlier versions created and no query uses any more. Every
+# index makes the inserts of a load slower.
+DROPPED_INDEXES = ["ix_model_task_date", "ix_model_task_employee_name_date"]
+
+def create_indexes():
+  """
+    Declare the INDEXES on the tables and create the ones that are not in
+    the DB yet, so they also end up in DBs created before they were added.
+    The DROPPED_INDEXES are removed. Only SQLite is asked which indexes it
+    has; other DBs get every index created, and refuse those they already
+    have, and keep the dropped ones.
+  """
+  sqlite = metadata.bind.name == 'sqlite'
+  if sqlite:
+    existing = set([name for (name,) in metadata.bind.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'")])
+  for entity, columns in INDEXES:
+    table = entity.table
+    name = "ix_%s_%s" % (table.name, "_".join(columns))
+    if name in [index.name for index in table.indexes]:
+      continue
+    index = Index(name, *[table.c[column] for column in columns])
+    if not sqlite:
+      try:
+        index.create()
+      except DBAPIError:
+        log.debug("Index %s is already in the DB" % name)
+    elif name not in existing:
+      index.create()
+  if sqlite:
+    for name in DROPPED_INDEXES:
+      if name in existing:
+        metadata.bind.execute("DROP INDEX %s" % name)
+
+def add_task_digests():
+  """
+    Add the Task.digest column to a DB created before it existed, which
+    setup_all() does not do, and fill it in with the digests the loaded
+    entries would have got. Repeated entries are numbered in the order
+    they were loaded, like CSVDBMapper does. The employee name is split
+    into first and last name at the first blank, so the tasks of someone
+    with a blank in the first name get other digests and are loaded again
+    if a file with them is.
+  """
+  task = Task.table
+  if 'digest' in Table(task.name, MetaData(metadata.bind), autoload=True).c.keys():
+    return
+  log.info("Adding the digests of the tasks in the DB")
+  metadata.bind.execute("ALTER TABLE %s ADD COLUMN digest VARCHAR(40)" % task.name)
+  for index in task.indexes:
+    if 'digest' in [column.key for column in index.columns]:
+      index.create()
+
+  project = Project.table
+  customer = Customer.table
+  query = select([task.c.id, task.c.date, customer.c.name, project.c.name, task.c.name,
+                  task.c.hours, task.c.employee_name, task.c.billable],
+                 from_obj=[task.outerjoin(project).outerjoin(customer)], order_by=[task.c.id])
+  rows = []
+  occurrences = {}
+  for (id, date, customer_name, project_name, name, hours, employee, billable) in metadata.bind.execute(query):
+    (first_name, blank, last_name) = employee.partition(u" ")
+    digest = _digest(unicode(date), customer_name, project_name, name, hours, first_name, last_name, billable)
+    count = occurrences[digest] = occurrences.get(digest, 0) + 1
+    if count > 1:
+      digest = u"%s-%d" % (digest, count)
+    rows.append({ 'task_id': id, 'digest': digest })
+  if len(rows) > 0:
+    metadata.bind.execute(task.update(task.c.id == bindparam('task_id'), values={ task.c.digest: bindparam('digest') }), rows)
+
+class _TextFactory(PoolListener):
+  """
+    SQLAlchemy 0.4 binds Unicode values as UTF-8 bytes, which the sqlite3
+    module of Python 2.6 and later refuses for anything but ASCII unless
+    the text_factory of the connection is changed. Unicode columns are
+    decoded by SQLAlchemy when they are read.
+  """
+  def connect(self, dbapi_con, con_record):
+    dbapi_con.text_factory = str
+
+def create_bind(url):
+  "The engine for the DB url, e.g. cfg['db.bind'], to use as metadata.bind."
+  engine = create_engine(url)
+  if engine.name == 'sqlite':
+    engine.pool.add_listener(_TextFactory())
+  return engine
+
+class Checkpoint(Entity):
+  """
+    How far a source file has been loaded. Written by the mappers in the
+    same transaction as the rows, see Mapper._flush().
+  """
+  source = Field(Unicode(255), primary_key=True)
+  offset = Field(Integer)
+  lineno = Field(Integer)
+
+  def __repr__(self):
+    return '<Checkpoint "%s" at line %d>' % (self.source, self.lineno)
+
+class DataVersion(Entity):
+  """
+    A counter per month ("YYYY-MM") that the mappers bump when they add
+    tasks to it, and one for ALL that is bumped by data every month depends
+    on, like purchase orders and coworkers. See CachedReport.
+  """
+  ALL = u"all"
+
+  period = Field(Unicode(7), primary_key=True)
+  version = Field(Integer)
+
+  @classmethod
+  def bump(cls, period):
+    version = cls.get(period)
+    if version is None:
+      version = cls(period=period, version=0)
+    version.version += 1
+
+  @classmethod
+  def versions(cls, periods):
+    "The versions of periods and of ALL as a dict, 0 for no data yet."
+    result = dict([(period, 0) for period in periods + [cls.ALL]])
+    for version in cls.query.filter(cls.period.in_(result.keys())):
+      result[version.period] = version.version
+    return result
+
+class CachedReport(Entity):
+  """
+    A generated report of a month. key identifies what it was generated
+    from, see MonthlyReport.cache_key() in monthly-report.py. The text is
+    stored as the UTF-8 bytes it was printed as.
+  """
+  period = Field(Unicode(7), primary_key=True)
+  key = Field(Unicode(32))
+  text = Field(Binary)
+
+class _Shared(dict):
+  """
+    Parsed files repeat the same few customers, projects, tasks and names on
+    every row. Looking a value up in a _Shared gives back one shared copy of
+    it, converted by the given function the first time it is seen, so a
+    whole export can be held in memory.
+  """
+  def __init__(self,convert):
+    dict.__init__(self)
+    self.convert = convert
+
+  def __missing__(self,key):
+    value = self[key] = self.convert(key)
+    return value
+
+_strings = _Shared(lambda value: value)
+_floats = _Shared(float)
+
+def _number(value):
+  "An integer, None for an empty value. Raises ValueError for anything else."
+  if value.strip() == u"":
+    return None
+  return int(value)
+
+_numbers = _Shared(_number)
+
+# Harvest dates (YYYY-MM-DD) as datetime.date and as day numbers
+_dates = _Shared(lambda date: datetime.datetime.strptime(date, "%Y-%m-%d").date())
+_days = _Shared(lambda date: _dates[date].toordinal())
+
+def _checked_date(date):
+  "date, if it is a date in YYYY-MM-DD format. Raises ValueError if not."
+  _dates[date]
+  return date
+
+_date_strings = _Shared(_checked_date)
+_billable = _Shared(lambda value: value == u"billable")
+_employee = _Shared(lambda value: value == u"employee")
+_approved = _Shared(lambda value: value == u"yes")
+
 class POEntry(object):
   """
     A data class that holds information from a Purchase Order CSV file.
     employee,customer,reference,price,start,stop,po-number
   """
+  __slots__ = ('employee', 'customer', 'reference', 'price', 'start', 'stop', 'number')
+
   def __init__(self,employee,customer,reference,price,start,stop,number):
-    self.employee = employee
-    self.customer = customer
-    self.reference = reference
-    self.price = price
-    self.start = start
-    self.stop = stop
-    self.number = number
+    PURCHASE_ORDERS.convert(self, (employee, customer, reference, price, start, stop, number))
 
 class CWEntry(object):
+  __slots__ = ('employee', 'number', 'office')
+
   def __init__(self,employee,number,office):
-    self.employee = employee
-    self.number = number
-    self.office = office
+    COWORKERS.convert(self, (employee, number, office))
     
 class TimeEntry(object):
   """
@@ -122,43 +418,196 @@ class TimeEntry(object):
     # 15)  Department
 
   """
+  __slots__ = ('date', 'customer', 'project', 'project_code', 'task', 'note',
+               'hours', 'first_name', 'last_name', 'billable', 'evsc',
+               'approved', 'rate', 'cost', 'department')
+
   def __init__(self,date,customer,project,project_code,task,note,hours,first_name,last_name,billable,evsc,approved,rate,cost,department):
-    self.date = date
-    self.customer = customer
-    self.project = project
-    self.project_code = project_code
-    self.task = task
-    self.note = note
-    self.hours = float(hours)
-    self.first_name = first_name
-    self.last_name = last_name
-    if billable == "billable":
-      self.billable = True
-    else:
-      self.billable = False
-    if evsc == "employee":
-      self.evsc = True
-    else:
-      self.evsc = False
-    if approved == "yes":
-      self.approved = True
-    else:
-      self.approved = False
-    self.rate = float(rate)
-    self.cost = float(cost)
-    #self.digest = self._calcdigest()
-    self.department = department
+    HARVEST.convert(self, (date, customer, project, project_code, task, note, hours, first_name,
+                           last_name, billable, evsc, approved, rate, cost, department))
   
   def _calcdigest(self):
-    import md5
-    str = "%s%s%s%s%s%s%s%s" % (self.date,self.customer,self.project,self.task,self.hours,self.first_name,self.last_name,self.billable)
-    hexdigest=md5.md5(str.encode('iso-8859-1')).hexdigest()
-    return unicode(hexdigest, 'utf-8')
+    return _digest(self.date,self.customer,self.project,self.task,self.hours,self.first_name,self.last_name,self.billable)
+
+  # Computed when asked for, so plain parsing does not pay for it
+  digest = property(_calcdigest)
 
   def __str__(self):
     return "%s - %s %s, %0.2f hours at %s working with %s" % (self.date, self.first_name, self.last_name, self.hours, self.customer, self.task) 
 
 
+# The CSV files update_db.py loads. CSVFile decodes their rows with these
+# instead of the __init__ of the entry classes, see csvparser.Schema. The
+# __init__ of each entry class converts its arguments with its schema too.
+HARVEST = register(Schema("Harvest", TimeEntry, [
+  ("Date", 'date', _date_strings),
+  ("Client", 'customer', _strings),
+  ("Project", 'project', _strings),
+  ("Project Code", 'project_code', _strings),
+  ("Task", 'task', _strings),
+  ("Notes", 'note', None),
+  ("Hours", 'hours', _floats),
+  ("First Name", 'first_name', _strings),
+  ("Last Name", 'last_name', _strings),
+  ("Billable?", 'billable', _billable),
+  ("Employee?", 'evsc', _employee),
+  ("Approved?", 'approved', _approved),
+  ("Hourly Rate", 'rate', _floats),
+  ("Cost", 'cost', _floats),
+  ("Department", 'department', _strings)]))
+
+PURCHASE_ORDERS = register(Schema("PurchaseOrder", POEntry, [
+  ("employee", 'employee', _strings),
+  ("customer", 'customer', _strings),
+  ("reference", 'reference', None),
+  ("price", 'price', None),
+  ("start", 'start', _date_strings),
+  ("stop", 'stop', _date_strings),
+  ("po-number", 'number', None)]))
+
+COWORKERS = register(Schema("CoWorker", CWEntry, [
+  ("employee", 'employee', _strings),
+  ("employee number", 'number', _numbers),
+  ("branch office", 'office', _strings)]))
+
+def _digest(date,customer,project,task,hours,first_name,last_name,billable):
+  "The digest of a time record, see TimeEntry.digest."
+  str = u"%s|%s|%s|%s|%s|%s|%s|%s" % (date,customer,project,task,hours,first_name,last_name,billable)
+  hexdigest=hashlib.md5(str.encode('utf-8')).hexdigest()
+  return unicode(hexdigest, 'utf-8')
+
+class _Codes(dict):
+  """
+    Dictionary encoding of a text column. Every distinct value gets the next
+    integer code when it is first looked up, values[code] gives it back.
+  """
+  def __init__(self):
+    dict.__init__(self)
+    self.values = []
+
+  def __missing__(self,key):
+    code = self[key] = len(self.values)
+    self.values.append(key)
+    return code
+
+
+class TimeEntryBatch(object):
+  """
+    The time records of a number of CSV lines stored column by column, see
+    CSVFile.batches(). Dates are day numbers (date.toordinal()), customer,
+    project, task and employee are integer codes into dictionaries that
+    are shared by all batches of a file, employee values being (first name,
+    last name). After freeze() the columns are numpy arrays, or
+    array.array if numpy is not installed.
+  """
+  TEXT = ('customer', 'project', 'task', 'employee')
+  FLOATS = ('hours', 'rate', 'cost')
+  FLAGS = ('billable', 'approved', 'evsc')
+  # The array.array type codes and the numpy types they are frozen to
+  TYPES = [('date', 'i', 'int32')] + \
+          [(name, 'i', 'int32') for name in TEXT] + \
+          [(name, 'd', 'float64') for name in FLOATS] + \
+          [(name, 'b', 'bool') for name in FLAGS]
+
+  def __init__(self,codes=None):
+    if codes is None:
+      codes = dict([(name, _Codes()) for name in TimeEntryBatch.TEXT])
+    self.codes = codes
+    for name, typecode, dtype in TimeEntryBatch.TYPES:
+      setattr(self, name, array.array(typecode))
+
+  def __len__(self):
+    return len(self.date)
+
+  def append(self,fields):
+    """
+      Add a row of TimeEntry fields. Raises ValueError for a bad value, and
+      then nothing has been added.
+    """
+    (date,customer,project,project_code,task,note,hours,first_name,last_name,billable,evsc,approved,rate,cost,department) = fields
+    # The values that can be bad are converted before any column grows
+    values = (_days[date], _floats[hours], _floats[rate], _floats[cost])
+    codes = self.codes
+    self.date.append(values[0])
+    self.customer.append(codes['customer'][customer])
+    self.project.append(codes['project'][project])
+    self.task.append(codes['task'][task])
+    self.employee.append(codes['employee'][(first_name, last_name)])
+    self.hours.append(values[1])
+    self.rate.append(values[2])
+    self.cost.append(values[3])
+    self.billable.append(billable == u"billable")
+    self.evsc.append(evsc == u"employee")
+    self.approved.append(approved == u"yes")
+
+  def freeze(self):
+    "Turn the columns into numpy arrays, if numpy is there. Returns self."
+    if numpy is not None:
+      for name, typecode, dtype in TimeEntryBatch.TYPES:
+        column = numpy.frombuffer(getattr(self, name), typecode)
+        setattr(self, name, column.astype(dtype))
+    return self
+
+  def next_batch(self):
+    "A new empty batch that uses the same dictionaries."
+    return TimeEntryBatch(self.codes)
+
+  def values(self,name):
+    """
+      The decoded values of a column as a list: text as unicode (employees
+      as "first last"), dates as YYYY-MM-DD, flags as booleans.
+    """
+    return self._decode(name, getattr(self, name).tolist())
+
+  def _decode(self,name,column):
+    if name == 'date':
+      days = {}
+      for day in set(column):
+        days[day] = unicode(datetime.date.fromordinal(day).isoformat())
+      return map(days.__getitem__, column)
+    if name == 'employee':
+      names = [u"%s %s" % value for value in self.codes[name].values]
+      return map(names.__getitem__, column)
+    if name in TimeEntryBatch.TEXT:
+      return map(self.codes[name].values.__getitem__, column)
+    if name in TimeEntryBatch.FLAGS:
+      return map(bool, column)
+    return column
+
+  def digests(self):
+    "The TimeEntry.digest of every row."
+    columns = [self.values(name) for name in ('date', 'customer', 'project', 'task', 'hours')]
+    employees = self.codes['employee'].values
+    columns.append([employees[code][0] for code in self.employee.tolist()])
+    columns.append([employees[code][1] for code in self.employee.tolist()])
+    columns.append(self.values('billable'))
+    return map(_digest, *columns)
+
+  def sum_by(self,keys,column='hours'):
+    """
+      Sum a column grouped by the columns in keys. Returns a dict from the
+      tuples of decoded key values to the sums, e.g.
+      batch.sum_by(('employee', 'billable'))[(u"Emil Erlandsson", True)]
+    """
+    values = getattr(self, column)
+    if numpy is not None and isinstance(values, numpy.ndarray) and len(self) > 0:
+      # One number per group, so numpy can do the grouping and summing and
+      # only the first row of every group has to be decoded
+      group = numpy.zeros(len(self), numpy.int64)
+      for key in keys:
+        codes = getattr(self, key).astype(numpy.int64)
+        group = group * (int(codes.max()) + 1) + codes
+      unique, first, inverse = numpy.unique(group, return_index=True, return_inverse=True)
+      sums = numpy.bincount(inverse, weights=values).tolist()
+      groups = zip(*[self._decode(key, getattr(self, key)[first].tolist()) for key in keys])
+      return dict(zip(groups, sums))
+    groups = zip(*[self.values(key) for key in keys])
+    totals = {}
+    for group, value in zip(groups, values):
+      totals[group] = totals.get(group, 0.0) + value
+    return totals
+
+
 # Unit tests below
 #----------------------------------------------------------------------------
 
@@ -172,11 +621,86 @@ class TestTimeEntry(unittest.TestCase):
     for entry in csv:
       self.assertEquals(0.0, entry.cost * entry.rate, "The cost and rate is always 0.0")
       self.assertEquals("200", entry.date[:3], "The first three chars should be 200")
-    
+
+  def testdigest(self):
+    args = ["2009-05-04","Customer","Project","","Task","Note","7.5","Emil","Erlandsson","billable","employee","yes","0.0","0.0","Dev"]
+    a = TimeEntry(*args)
+    args[5] = "Another note"
+    self.assertEquals(a.digest, TimeEntry(*args).digest, "The note is not part of the digest")
+    args[6] = "8"
+    self.assertNotEquals(a.digest, TimeEntry(*args).digest)
+
+  def testshared(self):
+    args = [u"2009-05-04",u"Customer",u"Project",u"",u"Task",u"Note",u"7.5",u"Emil",u"Erlandsson",u"billable",u"employee",u"yes",u"0.0",u"0.0",u"Dev"]
+    a = TimeEntry(*args)
+    copies = [x.encode('utf-8').decode('utf-8') for x in args]
+    self.assert_(not copies[1] is args[1])
+    b = TimeEntry(*copies)
+    self.assert_(a.customer is b.customer)
+    self.assert_(a.hours is b.hours)
+    self.assertEquals(7.5, b.hours)
+
+  def testschema(self):
+    args = [u"2009-05-04",u"Customer",u"Project",u"",u"Task",u"Note",u"7.5",u"Emil",u"Erlandsson",u"billable",u"employee",u"yes",u"0.0",u"0.0",u"Dev"]
+    a = TimeEntry(*args)
+    b = HARVEST.decode(args)
+    self.assertEquals([getattr(a, name) for name in TimeEntry.__slots__],
+                      [getattr(b, name) for name in TimeEntry.__slots__])
+    args[0] = u"2009-05-32"
+    self.assertRaises(ValueError, TimeEntry, *args)
+
+  def testbatch(self):
+    args = [u"2009-05-04",u"Customer",u"Project",u"",u"Task",u"Note",u"7.5",u"Emil",u"Erlandsson",u"billable",u"employee",u"yes",u"0.0",u"0.0",u"Dev"]
+    rows = []
+    for (date, first_name, hours, billable) in [(u"2009-05-04", u"Emil", u"7.5", u"billable"),
+                                                (u"2009-05-05", u"Emil", u"2", u"non-billable"),
+                                                (u"2009-05-05", u"Anna", u"8", u"billable"),
+                                                (u"2009-05-06", u"Emil", u"1", u"billable")]:
+      rows.append(list(args))
+      (rows[-1][0], rows[-1][7], rows[-1][6], rows[-1][9]) = (date, first_name, hours, billable)
+    first = TimeEntryBatch()
+    for row in rows[:2]:
+      first.append(row)
+    second = first.freeze().next_batch()
+    for row in rows[2:]:
+      second.append(row)
+    second.freeze()
+    self.assert_(first.codes is second.codes, "The dictionaries are shared")
+    self.assertEquals([1, 0], second.employee.tolist(), "Anna is new, Emil is not")
+    self.assertEquals([u"2009-05-05", u"2009-05-06"], second.values('date'))
+    self.assertEquals([TimeEntry(*row).digest for row in rows], first.digests() + second.digests())
+    self.assertEquals({ (u"Emil Erlandsson", True): 7.5, (u"Emil Erlandsson", False): 2.0 },
+                      first.sum_by(('employee', 'billable')))
+    self.assertEquals({ (u"2009-05-05",): 8.0, (u"2009-05-06",): 1.0 }, second.sum_by(('date',)))
+
+  def testbadbatchrow(self):
+    (fd, path) = tempfile.mkstemp()
+    out = os.fdopen(fd, 'w')
+    out.write("Date,Client,Project,Project Code,Task,Notes,Hours,First Name,Last Name,Billable?,Employee?,Approved?,Hourly Rate,Cost,Department\n")
+    for (date, hours) in [("2009-05-04", "1"), ("2009-05-32", "2"), ("2009-05-05", "many"), ("2009-05-06", "3")]:
+      out.write("%s,Customer,Project,,Task,,%s,Emil,Erlandsson,billable,employee,yes,0.0,0.0,Dev\n" % (date, hours))
+    out.close()
+    try:
+      csv = CSVFile(path, TimeEntry)
+      batches = list(csv.batches(TimeEntryBatch, 10))
+      self.assertEquals(2, csv.rejected)
+      self.assertEquals(1, len(batches))
+      self.assertEquals([u"2009-05-04", u"2009-05-06"], batches[0].values('date'))
+      self.assertEquals([1.0, 3.0], list(batches[0].hours))
+    finally:
+      os.unlink(path)
+
+  def testcoworker(self):
+    self.assertEquals(0, CWEntry(u"Emil Erlandsson", u"0", u"Göteborg").number)
+    self.assertEquals(None, CWEntry(u"Emil Erlandsson", u" ", u"Göteborg").number)
+    self.assertRaises(ValueError, CWEntry, u"Emil Erlandsson", u"x", u"Göteborg")
+
 
 if __name__ == "__main__":
   unittest.main()
 else:
   from config import cfg
-  metadata.bind = cfg['db.bind']
+  metadata.bind = create_bind(cfg['db.bind'])
   setup_all(True)
+  add_task_digests()
+  create_indexes()
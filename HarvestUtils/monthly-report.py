@@ -22,184 +22,298 @@ You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
 import sys
-import datetime
-from time import strptime, strftime    
+from cStringIO import StringIO
+from optparse import OptionParser
+from sqlalchemy.orm import eagerload
 
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None  # Python 2.5, reports are rendered in one process
+
+import instrument
 from model import *
 from config import cfg
-from statistics_month import DateModel
-
-# Code from
-# http://code.activestate.com/recipes/521915/
-# Recipe 521915: start date and end date of given week      
-# Snippet start
-def _getWeekDetails(_weekNo, _Year, _weekStart): 
-  _weekNo = _weekNo - 1  # Quickfix for 2009
-  rslt = []
-  janOne = strptime('%s-01-01' % _Year, '%Y-%m-%d')
-  dayOfFirstWeek = ((7-int((strftime("%u",janOne)))+ int(_weekStart)) % 7)
-  if dayOfFirstWeek == 0:
-    dayOfFirstWeek = 7
-  dateOfFirstWeek = strptime('%s-01-%s' % (_Year, dayOfFirstWeek), '%Y-%m-%d')
-  dayOne = datetime.datetime( dateOfFirstWeek.tm_year, dateOfFirstWeek.tm_mon, dateOfFirstWeek.tm_mday )
-  daysToGo = 7*(int(_weekNo)-1)
-  lastDay = daysToGo+6
-  dayX = dayOne + datetime.timedelta(days = daysToGo)
-  dayY = dayOne + datetime.timedelta(days = lastDay)
-  resultDateX = strptime('%s-%s-%s' % (dayX.year, dayX.month, dayX.day), '%Y-%m-%d')
-  resultDateY = strptime('%s-%s-%s' % (dayY.year, dayY.month, dayY.day), '%Y-%m-%d')
-  rslt.append(resultDateX)
-  rslt.append(resultDateY)
-  return rslt   
-# Snippet end
-                       
+from statistics_month import DateModel, Statistics, WeekStatistics, iso_week, nest
+
+def _canonical(value):
+  "value with every dict turned into a sorted list of items, for hashing."
+  if isinstance(value, dict):
+    return sorted([(key, _canonical(item)) for key, item in value.items()])
+  return value
+
+def _render_unit(unit):
+  "The text of _render_employee(*unit), for Pool.imap()."
+  return _render_employee(*unit)
+
+def _ratio(billable, available):
+  "The billing ratio in percent, 0 if there is no available time."
+  if available == 0:
+    return 0
+  return (billable/available)*100
+
+def _employee_figures(days, name, entries):
+  """
+    The billing ratio figures (total, available, avail, billable) of an
+    employee in a report of a month with days working days, from the entries as _render_employee()
+    takes them. These are what the totals of the report are summed from.
+  """
+  total = 0
+  avail = 0
+  billable = 0
+  for (customer, projects) in entries:
+    for (project, tasks) in projects:
+      for (task, hours) in tasks:
+        if task in cfg["billable"]:
+          billable += hours
+        
+        if task in cfg["absence"]:
+          avail -=  hours
+          
+        total += hours
+  
+  available = days * 8
+  if cfg['parttime'].has_key(name.encode("utf-8")):
+    available = available * cfg['parttime'][name.encode("utf-8")]
+  return (total, available, avail, billable)
+
+def _render_employee(days, period, name, eno, entries, pos, weeks):
+  """
+    Render the section of an employee in the report of a month with days
+    working days, from the
+    entries (the dicts of _aggregate_by_employee() as lists of items, so
+    the order survives pickling), the POs as tuples and the
+    WeekStatistics of the weeks in period. No DB access, so this can run
+    in another process.
+  """
+  (total, available, avail, billable) = _employee_figures(days, name, entries)
+  result_rpt = ":: %s (%d) ::\n\n- Reported time\n" % (name.encode("utf-8"), eno)
+  for (customer, projects) in entries:
+    for (project, tasks) in projects:
+      for (task, hours) in tasks:
+        result_rpt += "\t* %s / %s / %s:%0.2f\n" % (customer, project, task, hours)
+  result_rpt += "\t* Total time reported: %0.2f\n" % total
+  
+  result_rpt += "\n- Purchase orders\n"
+  if len(pos) > 0:
+    
+    for (customer, reference, number, start, stop, price) in pos:
+       result_rpt += "\t- %s (%s)\n" % (customer.encode("utf-8"), reference.encode("utf-8"))  
+       result_rpt += "\t\t* PO-number: %s\n" % str(number).encode("utf-8")
+       result_rpt += "\t\t* Period: %s to %s\n" % (start, stop) 
+       result_rpt += "\t\t* Price: %0.2f SEK/hour\n" % (price) 
+  else:
+     result_rpt +=  "\t * NO PURCHASE ORDERS FOUND!\n"
+  
+  result_rpt += "\n- Billing ratio\n"
+  result_rpt += "\t* Billable hours: %0.2f\n" % billable
+  result_rpt += "\t* Available hours: %0.2f\n" % (available + avail)
+  result_rpt += "\t* Ratio: %d percent\n" % _ratio(billable, available + avail)
+  
+  result_rpt += "\n- Salary information\n"
+  purple_hearts = 0
+  overtime = 0
+  for week in period:
+    (weekstart, weekstop) = weeks.week_range(week)
+    result_rpt += "\t - Week %d from %s to %s\n" % (week, weekstart, weekstop)
+    
+    for (task, date, hours) in weeks.internal_tasks(name, week):
+      result_rpt += "\t\t * %s %s - %0.2f hours\n" % (task.encode("utf-8"), date, hours)
+    
+    otime = weeks.overtime(name, week)
+    result_rpt += "\t\t * Övertid: %0.2f hours\n" %  otime
+    overtime += otime   
+      
+    result_rpt += "\t\t * Purple Heart time - %0.2f hours\n" % weeks.purple_heart_time(name, week)
+      
+    if weeks.purple_heart(name, week):
+      purple_hearts += 1
+    
+    result_rpt +=  "\t\t * Weekly total: %0.2f hours\n\n" % weeks.week_total(name, week)
+  
+  result_rpt += "\t - Övertidsdelta: %0.2f hours\n\n" % (overtime)
+  extra = 1
+  if purple_hearts == len(period):
+    extra = 2
+  result_rpt += "\t - Purple Hearts: %d of %d = %d kr\n" % (purple_hearts, len(period), (purple_hearts*350) * extra )   
+  
+  result_rpt += "\n\n\n"
+  return result_rpt
+
+class _Tee(object):
+  "Writes to out and keeps a copy of everything written."
+
+  def __init__(self, out):
+    self.out = out
+    self.copy = StringIO()
+
+  def write(self, text):
+    self.out.write(text)
+    self.copy.write(text)
+
+  def getvalue(self):
+    return self.copy.getvalue()
+
 class MonthlyReport(object):
-  def __init__(self, period):
+
+  # Bump when the report text changes, so that reports cached by older
+  # code are generated again
+  CACHE_FORMAT = 1
+  # The config the report depends on
+  CACHE_CONFIG = ('daysofmonth', 'holidays', 'purple_heart', 'normal_time', 'billable', 'parttime', 'absence')
+
+  def __init__(self, period, processes=None):
+    """
+      @param period is the month, YYYY-MM
+      @param processes is the number of processes that render the report,
+             0 for one per CPU (cfg['report_processes'])
+    """
+    if processes is None:
+      processes = cfg.get('report_processes', 1)
+    self.processes = processes or None
     self.month = "%s-01" % period
     self.date = DateModel(self.month)
     self.start = self.date.get_month_start()
     self.stop = self.date.get_month_stop()
     self.period = cfg['purple_heart'][int(period.split("-")[1])]
+    # Working days, cfg['daysofmonth'] overrides those of Day
+    self.days = cfg.get('daysofmonth', {}).get(self.date.get_month_number())
+    if self.days is None:
+      self.days = Day.working_days(unicode(period))
+
+  def cache_key(self):
+    """
+      A digest of what the report is generated from: CACHE_FORMAT, the
+      config and the DataVersion of the months its weeks are in.
+    """
+    months = set([self.month[:7]])
+    months.add(iso_week(self.date.year, self.period[0])[0].strftime("%Y-%m"))
+    months.add(iso_week(self.date.year, self.period[-1])[1].strftime("%Y-%m"))
+    versions = DataVersion.versions([unicode(month) for month in months])
+    config = [(key, _canonical(cfg.get(key))) for key in MonthlyReport.CACHE_CONFIG]
+    key = repr((MonthlyReport.CACHE_FORMAT, config, sorted(versions.items())))
+    return unicode(hashlib.md5(key).hexdigest())
+
+  def get_cached_report(self):
+    "The same as write_cached_report(), but the report is returned as a string."
+    out = StringIO()
+    self.write_cached_report(out)
+    return out.getvalue()
+
+  def write_cached_report(self, out):
+    """
+      The same as write_report(), but the report is kept in CachedReport
+      and only generated again when cache_key() has changed.
+    """
+    stage = instrument.start("cache")
+    key = self.cache_key()
+    cached = CachedReport.get(unicode(self.month[:7]))
+    instrument.stop(stage)
+    if cached is not None and cached.key == key:
+      out.write(str(cached.text))
+      return
+    copy = _Tee(out)
+    self.write_report(copy)
+    if cached is None:
+      cached = CachedReport(period=unicode(self.month[:7]))
+    cached.key = key
+    cached.text = copy.getvalue()
+    session.commit()
           
-  def get_report(self):
-    "Return a string ready to be printed." 
+  def get_data(self):
+    """
+      Fetch what the report shows, with one query each: the hours by
+      employee, the POs by employee and the WeekStatistics.
+    """
+    stage = instrument.start("fetch")
+    stats = Statistics(self.date)
+    data = (self._aggregate_by_employee(stats.hours_by_task()),
+            stats.purchase_orders(),
+            WeekStatistics(self.date.year, self.period))
+    instrument.stop(stage)
+    return data
+
+  def get_report(self, data=None, totals=None):
+    "The same as write_report(), but the report is returned as a string."
+    out = StringIO()
+    self.write_report(out, data, totals)
+    return out.getvalue()
+
+  def write_report(self, out, data=None, totals=None):
+    """
+      Write the report to out, a file or anything else with a write()
+      method. data is what get_data() returns, fetched here if it is not
+      given. The billing ratio figures of every employee are also added to
+      totals, if it is a YearToDate.
+
+      The header and the statistics are written first, from the figures
+      of the employees, and then the section of every employee as soon as
+      it has been rendered. Only the sections that are being rendered are
+      kept in memory.
+    """ 
     
+    report = instrument.start("report")
     total_time = 0
     total_billable = 0
     office_time = {}
     not_active = []  # Employees with no time entries at all
     incomplete = []  # Employees with some entries, but not enough
     
-    result_header = "Billing report for %s to %s (%d days total)\n\n" % (self.start, self.stop, cfg['daysofmonth'][self.date.get_month_number()])  
+    out.write("Billing report for %s to %s (%d days total)\n\n" % (self.start, self.stop, self.days))
     result_stats = ""
-    result_rpt = ""
+
+    # Everything for the month is fetched up front
+    if data is None:
+      data = self.get_data()
+    (employee_entries, employee_pos, weeks) = data
 
     # x.name.encode('utf-8')
-    employees = Employee.query.order_by(Employee.number)
+    employees = Employee.query.options(eagerload('office')).order_by(Employee.number)
 
+    # The sections of the employees are independent of each other, see
+    # _sections()
+    units = []
     for employee in employees:
-      entries = self._get_employee_entries(employee.name.encode("utf-8"))
+      entries = employee_entries.get(employee.name, {})
       
       if len(entries.keys()) > 0:
-        total = 0
-        avail = 0
-        billable = 0
         eno = -1
         if employee.number is not None:
           eno = employee.number
-        result_rpt += ":: %s (%d) ::\n\n- Reported time\n" % (employee.name.encode("utf-8"), eno)
-        for customer in entries.keys():
-          for project in entries[customer].keys():
-            for task in entries[customer][project].keys():
-              result_rpt += "\t* %s / %s / %s:%0.2f\n" % (customer, project, task, entries[customer][project][task])
-              if task in cfg["billable"]:
-                billable += entries[customer][project][task]
-              
-              if task in cfg["absence"]:
-                avail -=  entries[customer][project][task]
-                
-              total += entries[customer][project][task]
-        result_rpt += "\t* Total time reported: %0.2f\n" % total
-        
-        
-        available = cfg['daysofmonth'][self.date.get_month_number()] * 8
-        if cfg['parttime'].has_key(employee.name.encode("utf-8")):
-          available = available * cfg['parttime'][employee.name.encode("utf-8")]
+        office = "No office"
+        if employee.office is not None:
+          office = employee.office.name.encode('utf-8')
+        pos = [(po.customer, po.reference, po.number, po.start, po.stop, po.price)
+               for po in employee_pos.get(employee.name, [])]
+        entries = [(customer, [(project, tasks.items()) for (project, tasks) in projects.items()])
+                   for (customer, projects) in entries.items()]
+        units.append((self.days, self.period,
+                      employee.name, eno, entries, pos, weeks))
+        (total, available, avail, billable) = _employee_figures(self.days, employee.name, entries)
         
         total_time += available + avail
         total_billable += billable
         
-        office = "No office"
-        if employee.office is not None:
-          office = employee.office.name.encode('utf-8')
         if not office_time.has_key(office):
           office_time[office] = { "total": 0, "billable": 0 }
         
         office_time[office]["total"] += available + avail
         office_time[office]["billable"] += billable
-        
+
+        if totals is not None:
+          totals.add(employee.name.encode("utf-8"), office, total, available + avail, billable)
           
         if total < available:
           incomplete.append((employee, (available-total)))
-          
-        pos = PurchaseOrder.query.filter(PurchaseOrder.start <= self.stop)
-        pos = pos.filter(PurchaseOrder.stop >= self.start)
-        pos = pos.filter(PurchaseOrder.employee == employee)
-        
-        result_rpt += "\n- Purchase orders\n"
-        if pos.first() is not None:
-          
-          for po in pos:
-             result_rpt += "\t- %s (%s)\n" % (po.customer.encode("utf-8"), po.reference.encode("utf-8"))  
-             result_rpt += "\t\t* PO-number: %s\n" % str(po.number).encode("utf-8")
-             result_rpt += "\t\t* Period: %s to %s\n" % (po.start, po.stop) 
-             result_rpt += "\t\t* Price: %0.2f SEK/hour\n" % (po.price) 
-        else:
-           result_rpt +=  "\t * NO PURCHASE ORDERS FOUND!\n"
-        
-        result_rpt += "\n- Billing ratio\n"
-        result_rpt += "\t* Billable hours: %0.2f\n" % billable
-        result_rpt += "\t* Available hours: %0.2f\n" % (available + avail)
-        result_rpt += "\t* Ratio: %d percent\n" % ((billable/(available+avail))*100)
-        
-        result_rpt += "\n- Salary information\n"
-        purple_hearts = 0
-        overtime = 0
-        for week in self.period:
-          winfo = _getWeekDetails(week, 2009, 2)
-          weekstart = strftime("%Y-%m-%d", winfo[0])                     
-          weekstop = strftime("%Y-%m-%d", winfo[1])
-          result_rpt += "\t - Week %d from %s to %s\n" % (week, weekstart, weekstop)
-          
-          tasks = Task.query.filter(Task.date >= weekstart) 
-          tasks = tasks.filter(Task.date <= weekstop)
-          tasks = tasks.filter(Task.employee == employee)
-          
-          week_total = 0
-          week_billable = 0
-          for task in tasks:
-            if not task.name == "Kompledighet":
-              week_total += task.hours
-            
-            if task.name.encode("utf-8") in cfg["billable"]:
-               week_billable += task.hours            
-            
-            if task.project.name == "Internal" and task.name != "Kompetensutveckling":
-              result_rpt += "\t\t * %s %s - %0.2f hours\n" % (task.name.encode("utf-8"), task.date, task.hours)
-            
-            if task.name == "Komptid" or task.name == "Uttag av komp":
-              week_total = week_total - task.hours
-          
-          normal_time = cfg['normal_time']
-          if cfg['parttime'].has_key(employee.name.encode("utf-8")):
-            normal_time = normal_time * cfg['parttime'][employee.name.encode("utf-8")]
-          
-          otime = week_total - normal_time
-          result_rpt += "\t\t * Övertid: %0.2f hours\n" %  otime
-          overtime += otime   
-            
-          result_rpt += "\t\t * Purple Heart time - %0.2f hours\n" % (week_billable)
-            
-          if week_billable >= cfg["normal_time"]:
-            purple_hearts += 1
-          
-          result_rpt +=  "\t\t * Weekly total: %0.2f hours\n\n" % (week_total)
-        
-        result_rpt += "\t - Övertidsdelta: %0.2f hours\n\n" % (overtime)
-        extra = 1
-        if purple_hearts == len(self.period):
-          extra = 2
-        result_rpt += "\t - Purple Hearts: %d of %d = %d kr\n" % (purple_hearts, len(self.period), (purple_hearts*350) * extra )   
-        
-        result_rpt += "\n\n\n"
       else:
         not_active.append(employee.name.encode("utf-8"))
       
-    result_stats = "- Billing ratio\n\t- Company total\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" %  (total_time, total_billable, ((total_billable/total_time)*100))
+    result_stats = "- Billing ratio\n\t- Company total\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" %  (total_time, total_billable, _ratio(total_billable, total_time))
     
     for office in office_time.keys():
-      result_stats += "\t- %s\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (office, office_time[office]["total"], office_time[office]["billable"], ((office_time[office]["billable"]/office_time[office]["total"])*100))
+      result_stats += "\t- %s\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (office, office_time[office]["total"], office_time[office]["billable"], _ratio(office_time[office]["billable"], office_time[office]["total"]))
     
     if len(incomplete) > 0:
       result_stats += "\n\n- Incomplete reports\n"
@@ -207,37 +321,148 @@ class MonthlyReport(object):
       result_stats += "\t* %s is missing %0.2f hours\n" % (emp.name.encode('utf-8'), hours)
     
     result_stats += "\n\n"
+    out.write(result_stats)
     
-    return result_header + result_stats + result_rpt
+    stage = instrument.start("render")
+    for section in self._sections(units):
+      out.write(section)
+    instrument.stop(stage, len(units))
+    instrument.stop(report)
 
-  def _get_employee_entries(self,employee):
-    tasks = Task.query.filter(Task.date >= self.start)
-    tasks = tasks.filter(Task.date <= self.stop)
-    tasks = tasks.filter(Task.employee.has(name=unicode(employee,"utf-8")))
-    return self._aggregate_by_customer(tasks)
+  def _sections(self, units):
+    """
+      Render the employee sections with _render_employee(), in a pool of
+      self.processes processes if there is more than one employee. The
+      sections are yielded in the order of units, as they are done.
+    """
+    if self.processes == 1 or multiprocessing is None or len(units) < 2:
+      for unit in units:
+        yield _render_unit(unit)
+      return
+    processes = self.processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+      # A few chunks per process keeps them all busy without handing out
+      # one employee at a time
+      chunk = max(1, len(units) / (4 * processes))
+      for section in pool.imap(_render_unit, units, chunk):
+        yield section
+    finally:
+      pool.terminate()
+      pool.join()
 
-  def _aggregate_by_customer(self, tasks):
-    result = {}
-    for task in tasks:
-      customer =  task.project.customer.name.encode("utf-8")
-      project =  task.project.name.encode("utf-8")
-      task_name = task.name.encode("utf-8")
+  def _aggregate_by_employee(self, rows):
+    """
+      Nest the rows of Statistics.hours_by_task() as
+      result[employee name][customer][project][task] = hours
+    """
+    return nest([(employee, customer.encode("utf-8"), project.encode("utf-8"), task_name.encode("utf-8"), hours)
+                 for (employee, customer, project, task_name, hours) in rows])
 
-      if not result.has_key(customer):
-        result[customer] = {}
+class YearToDate(object):
+  "Sums the billing ratio figures of the employees over a number of months."
 
-      if not result[customer].has_key(project):
-        result[customer][project] = {}
+  def __init__(self):
+    self.employees = []  # In the order they were first added
+    self.by_employee = {}  # Name -> [reported, available, billable]
+    self.by_office = {}
+    self.company = [0, 0, 0]
 
-      if not result[customer][project].has_key(task_name):
-        result[customer][project][task_name] = 0
+  def add(self, employee, office, reported, available, billable):
+    if not self.by_employee.has_key(employee):
+      self.employees.append(employee)
+    for figures in (self.by_employee.setdefault(employee, [0, 0, 0]),
+                    self.by_office.setdefault(office, [0, 0, 0]),
+                    self.company):
+      figures[0] += reported
+      figures[1] += available
+      figures[2] += billable
 
-      result[customer][project][task_name] += task.hours
+  def get_report(self, start, stop):
+    result = "Year to date report for %s to %s\n\n- Billing ratio\n" % (start, stop)
+    offices = [(office, self.by_office[office]) for office in sorted(self.by_office.keys())]
+    for (name, (reported, available, billable)) in [("Company total", self.company)] + offices:
+      result += "\t- %s\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (name, available, billable, _ratio(billable, available))
+    result += "\n- Employees\n"
+    for employee in self.employees:
+      (reported, available, billable) = self.by_employee[employee]
+      result += "\t* %s: %0.2f hours reported, %0.2f available, %0.2f billable, %d percent\n" % (employee, reported, available, billable, _ratio(billable, available))
     return result
 
+
+class ReportBatch(object):
+  """
+    The monthly reports of the months first to last ("YYYY-MM") followed by
+    year to date totals. The hours of all months are fetched with one
+    query, the POs with one and the weeks with one per year.
+  """
+
+  def __init__(self, first, last, processes=None):
+    self.first = DateModel("%s-01" % first)
+    self.last = DateModel("%s-01" % last)
+    self.reports = []
+    date = self.first
+    while (date.year, date.month) <= (self.last.year, self.last.month):
+      self.reports.append(MonthlyReport("%d-%02d" % (date.year, date.month), processes))
+      date = date.next()
+
+  def get_report(self):
+    "The same as write_report(), but the report is returned as a string."
+    out = StringIO()
+    self.write_report(out)
+    return out.getvalue()
+
+  def write_report(self, out):
+    "Write the reports to out, one month at a time."
+    batch = instrument.start("batch")
+    stage = instrument.start("fetch")
+    stats = Statistics(self.first, self.last)
+    hours = stats.hours_by_month()
+    pos = stats.purchase_orders()
+    weeks = {}
+    for report in self.reports:
+      weeks.setdefault(report.date.year, set()).update(report.period)
+    for year in weeks.keys():
+      weeks[year] = WeekStatistics(year, sorted(weeks[year]))
+    instrument.stop(stage)
+
+    totals = YearToDate()
+    for report in self.reports:
+      entries = report._aggregate_by_employee(hours.get(report.month[:7], []))
+      month_pos = {}
+      for employee, orders in pos.items():
+        orders = [po for po in orders if str(po.start) <= report.stop and str(po.stop) >= report.start]
+        if len(orders) > 0:
+          month_pos[employee] = orders
+      report.write_report(out, (entries, month_pos, weeks[report.date.year]), totals)
+      out.write("\n")
+    out.write(totals.get_report(stats.start, stats.stop))
+    instrument.stop(batch)
+
+
 if __name__ == "__main__":
-  if len(sys.argv) == 1:
-    print "Usage: python monthly-report.py YYYY-MM"
+  parser = OptionParser(usage="Usage: python monthly-report.py [options] YYYY-MM[..YYYY-MM]")
+  parser.add_option("--no-cache", dest="cache", action="store_false", default=cfg.get('report_cache', True),
+                    help="generate the report even if the month has not changed")
+  parser.add_option("-j", "--jobs", dest="processes", type="int",
+                    help="number of processes that render the report, 0 for one per CPU (default from config.py)")
+  parser.add_option("--profile", dest="profile", metavar="FILE",
+                    help="write the time, rows and SQL of every stage to FILE, as JSON or for flamegraph.pl if it ends with .folded")
+  (options, args) = parser.parse_args()
+  if options.profile is not None:
+    instrument.enable(metadata.bind)
+  if len(args) == 0:
+    parser.print_usage()
+  elif ".." in args[0]:
+    (first, last) = args[0].split("..")
+    ReportBatch(first, last, options.processes).write_report(sys.stdout)
+    print
   else:
-    report = MonthlyReport(sys.argv[1])
-    print report.get_report()
+    report = MonthlyReport(args[0], options.processes)
+    if options.cache:
+      report.write_cached_report(sys.stdout)
+    else:
+      report.write_report(sys.stdout)
+    print
+  if options.profile is not None:
+    instrument.disable().write(options.profile)
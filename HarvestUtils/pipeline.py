@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+pipeline.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+import instrument
+
+log = logging.getLogger("pipeline")
+
+class Stopped(Exception):
+  "Raised in a reading thread when the pipeline has been stopped."
+  pass
+
+class ReadAhead(object):
+  """
+    Reads the entries of a mapper in another thread and hands them over
+    through a bounded queue, in chunks of chunk_size entries. Every entry
+    comes with the file position after it, so the mapper checkpoints what
+    it has written and not what has been read.
+    @param mapper is the mapper whose entries should be read
+    @param chunk_size is the number of entries per chunk
+    @param max_chunks is the number of chunks that may wait in the queue
+  """
+
+  def __init__(self, mapper, chunk_size=1000, max_chunks=8):
+    self.mapper = mapper
+    self.chunk_size = chunk_size
+    self.queue = Queue.Queue(max_chunks)
+    self.stopped = False
+    self.last = None
+    self.thread = None
+
+  def start(self):
+    """
+      Read in a thread of its own instead of one of a Pipeline. Iterating
+      to the end, or giving up on it, stops the thread. Returns self.
+    """
+    self.thread = threading.Thread(target=self.read, name="reader")
+    self.thread.setDaemon(True)
+    self.thread.start()
+    return self
+
+  def read(self):
+    "Read all entries into the queue. Runs in the reading thread."
+    try:
+      position = self.mapper.csv.position
+      chunk = []
+      stage = instrument.start("read %s" % self.mapper.__class__.__name__)
+      for entry in self.mapper._entries():
+        chunk.append((entry, position()))
+        if len(chunk) >= self.chunk_size:
+          instrument.stop(stage, len(chunk))
+          self._put(chunk)
+          chunk = []
+          stage = instrument.start("read %s" % self.mapper.__class__.__name__)
+      instrument.stop(stage, len(chunk))
+      if len(chunk) > 0:
+        self._put(chunk)
+      self._put(None)
+    except Stopped:
+      pass
+    except:
+      try:
+        self._put(sys.exc_info())
+      except Stopped:
+        pass
+
+  def stop(self):
+    "Make the reading thread give up instead of waiting for room in the queue."
+    self.stopped = True
+
+  def join(self):
+    "Wait for the thread of start(), if any, to end. See stop()."
+    if self.thread is not None:
+      self.thread.join()
+
+  def position(self):
+    return self.last
+
+  def __iter__(self):
+    self.last = self.mapper.csv.position()
+    try:
+      while True:
+        # Time the writer waits for the reader
+        stage = instrument.start("wait")
+        item = self.queue.get()
+        instrument.stop(stage)
+        if item is None:
+          return
+        if isinstance(item, tuple):
+          raise item[0], item[1], item[2]
+        for (entry, self.last) in item:
+          yield entry
+    finally:
+      if self.thread is not None:
+        self.stop()
+        self.join()
+
+  def _put(self, item):
+    # Time the reader waits for room in the queue, i.e. for the writer
+    stage = instrument.start("blocked")
+    try:
+      while not self.stopped:
+        try:
+          self.queue.put(item, True, 0.5)
+          return
+        except Queue.Full:
+          pass
+      raise Stopped()
+    finally:
+      instrument.stop(stage)
+
+
+class Pipeline(object):
+  """
+    Maps a list of mappers to the DB. Up to threads files are parsed at the
+    same time by reading threads while a single writer, the calling thread,
+    maps the files one after another in the given order. The threads take
+    the files in order too, so the file the writer waits for is always
+    being read.
+    @param mappers is the list of mappers, in the order they should be written
+    @param threads is the number of reading threads
+  """
+
+  def __init__(self, mappers, threads=2):
+    self.mappers = mappers
+    self.threads = max(1, threads)
+    self.todo = Queue.Queue()
+    self.readers = []
+
+  def run(self):
+    # Checkpoints are read before any thread touches the files
+    for mapper in self.mappers:
+      mapper.prepare()
+      mapper.reader = ReadAhead(mapper, mapper.chunk_size)
+      self.readers.append(mapper.reader)
+      self.todo.put(mapper.reader)
+
+    workers = []
+    for i in range(min(self.threads, len(self.readers))):
+      worker = threading.Thread(target=self._work, name="reader-%d" % i)
+      worker.setDaemon(True)
+      worker.start()
+      workers.append(worker)
+
+    try:
+      for mapper in self.mappers:
+        log.info("Starting to map %s to the DB" % mapper.source)
+        mapper.map()
+    finally:
+      for reader in self.readers:
+        reader.stop()
+      for worker in workers:
+        worker.join()
+
+  def _work(self):
+    while True:
+      try:
+        reader = self.todo.get(False)
+      except Queue.Empty:
+        return
+      if reader.stopped:
+        return
+      reader.read()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+snapshot.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+import calendar
+import datetime
+import logging
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from optparse import OptionParser
+
+try:
+  import json
+except ImportError:
+  import simplejson as json  # Python 2.5
+
+try:
+  import numpy
+except ImportError:
+  numpy = None  # The columns are read into array.array and summed in Python
+
+import instrument
+
+log = logging.getLogger("snapshot")
+
+MAGIC = "HarvestUtils snapshot 1\n"
+
+# The columns of a snapshot, one value per row of DailyHours in id order:
+# the date as date.toordinal(), codes into the employee, project and task
+# lists of the header, and billable as 0 or 1. With the array.array type
+# codes and the numpy types they are read as.
+COLUMNS = [('date', 'i', 'int32'),
+           ('employee', 'i', 'int32'),
+           ('project', 'i', 'int32'),
+           ('task', 'i', 'int32'),
+           ('billable', 'b', 'int8'),
+           ('hours', 'd', 'float64')]
+
+# The same dimensions as Statistics.aggregate()
+DIMENSIONS = ('employee', 'customer', 'project', 'task', 'office', 'week', 'month', 'billable')
+
+def _align(offset):
+  "Columns start at multiples of 8 bytes, so they can be memory mapped."
+  return (offset + 7) & ~7
+
+def _ordinal(date):
+  "date.toordinal() of a date or a YYYY-MM-DD string."
+  if not isinstance(date, datetime.date):
+    date = datetime.date(*map(int, str(date)[:10].split("-")))
+  return date.toordinal()
+
+def _encode(values):
+  """
+    Dictionary encode values. Returns (the code of every value, the
+    distinct values in order of appearance).
+  """
+  codes = {}
+  distinct = []
+  result = []
+  for value in values:
+    if not codes.has_key(value):
+      codes[value] = len(distinct)
+      distinct.append(value)
+    result.append(codes[value])
+  return (result, distinct)
+
+def _write(path, header, columns):
+  """
+    Write the header and the COLUMNS, lists of header['rows'] values by
+    name, to a snapshot at path. The offsets of the columns are added to
+    the header. The file is replaced in one go, a reader never sees half
+    of it.
+  """
+  header['columns'] = []
+  offset = 0  # From the end of the header
+  for (name, typecode, dtype) in COLUMNS:
+    header['columns'].append([name, typecode, offset])
+    offset = _align(offset + header['rows'] * array.array(typecode).itemsize)
+  text = json.dumps(header)
+
+  temp = path + ".tmp"
+  out = file(temp, 'wb')
+  try:
+    out.write(MAGIC + struct.pack("<I", len(text)) + text)
+    base = _align(out.tell())
+    for (name, typecode, offset) in header['columns']:
+      out.write("\0" * (base + offset - out.tell()))
+      array.array(typecode, columns[name]).tofile(out)
+    out.close()
+    os.rename(temp, path)
+  except:
+    out.close()
+    os.unlink(temp)
+    raise
+
+def export(path, start=None, stop=None):
+  """
+    Write the daily hours from start to stop, by default all of them, and
+    the names they refer to to a snapshot at path. The file is replaced
+    in one go, a reader never sees half of it. Returns the number of rows.
+  """
+  # Only exporting needs the DB
+  from sqlalchemy import and_, select
+  from model import Customer, DailyHours, Employee, Office, Project, session
+
+  stage = instrument.start("export")
+  rollup = DailyHours.table
+  conditions = []
+  if start is not None:
+    conditions.append(rollup.c.date >= start)
+  if stop is not None:
+    conditions.append(rollup.c.date <= stop)
+  query = select([rollup.c.date, rollup.c.employee_name, rollup.c.project_id, rollup.c.task,
+                  rollup.c.billable, rollup.c.hours], and_(*conditions), order_by=[rollup.c.id])
+  rows = session.execute(query, mapper=DailyHours).fetchall()
+
+  employee = Employee.table
+  offices = dict(session.execute(select([employee.c.name, Office.table.c.name],
+                                        from_obj=[employee.outerjoin(Office.table)]), mapper=Employee).fetchall())
+  project = Project.table
+  projects = {}
+  for (id, name, customer) in session.execute(select([project.c.id, project.c.name, Customer.table.c.name],
+                                                     from_obj=[project.outerjoin(Customer.table)]), mapper=Project):
+    projects[id] = (name, customer)
+
+  (employee_codes, employees) = _encode([row[1] for row in rows])
+  (project_codes, project_ids) = _encode([row[2] for row in rows])
+  (task_codes, tasks) = _encode([row[3] for row in rows])
+  columns = {'date': [_ordinal(row[0]) for row in rows],
+             'employee': employee_codes,
+             'project': project_codes,
+             'task': task_codes,
+             'billable': [int(bool(row[4])) for row in rows],
+             'hours': [row[5] for row in rows]}
+
+  header = {'rows': len(rows),
+            'byteorder': sys.byteorder,
+            'employees': employees,
+            'offices': [offices.get(name) for name in employees],
+            'projects': [projects.get(id, (None, None))[0] for id in project_ids],
+            'customers': [projects.get(id, (None, None))[1] for id in project_ids],
+            'tasks': tasks}
+  _write(path, header, columns)
+  instrument.stop(stage, len(rows))
+  log.info("Wrote %d daily hours to %s" % (len(rows), path))
+  return len(rows)
+
+
+class Snapshot(object):
+  """
+    The daily hours of a snapshot file that export() wrote, memory mapped
+    column by column if numpy is installed and read into array.array if
+    not. aggregate() answers the same questions as the one of Statistics
+    without a DB.
+    @param path is the snapshot file
+  """
+
+  def __init__(self, path):
+    stage = instrument.start("snapshot")
+    handle = file(path, 'rb')
+    try:
+      if handle.read(len(MAGIC)) != MAGIC:
+        raise Exception, "%s is not a snapshot" % path
+      (length,) = struct.unpack("<I", handle.read(4))
+      header = json.loads(handle.read(length))
+      if header['byteorder'] != sys.byteorder:
+        raise Exception, "%s was written on a %s endian machine" % (path, header['byteorder'])
+      self.rows = header['rows']
+      base = _align(handle.tell())
+      types = dict([(name, dtype) for (name, typecode, dtype) in COLUMNS])
+      for (name, typecode, offset) in header['columns']:
+        if numpy is None:
+          column = array.array(typecode)
+          handle.seek(base + offset)
+          column.fromfile(handle, self.rows)
+        elif self.rows > 0:
+          column = numpy.memmap(path, types[name], 'r', base + offset, (self.rows,))
+        else:
+          column = numpy.zeros(0, types[name])
+        setattr(self, name, column)
+    finally:
+      handle.close()
+
+    # Every dimension is (column, a list from the column's codes to the
+    # codes of the dimension or None, the values of the dimension, the
+    # first code of the column)
+    (customers, customer_values) = _encode(header['customers'])
+    (projects, project_values) = _encode(header['projects'])
+    (offices, office_values) = _encode(header['offices'])
+    (self.first, self.last) = (0, -1)
+    if self.rows > 0 and numpy is not None:
+      (self.first, self.last) = (int(self.date.min()), int(self.date.max()))
+    elif self.rows > 0:
+      (self.first, self.last) = (min(self.date), max(self.date))
+    (weeks, week_values, months, month_values) = self._calendar()
+    self.between = None  # See _between()
+    self.dimensions = {'employee': ('employee', None, header['employees'], 0),
+                       'customer': ('project', customers, customer_values, 0),
+                       'project': ('project', projects, project_values, 0),
+                       'task': ('task', None, header['tasks'], 0),
+                       'office': ('employee', offices, office_values, 0),
+                       'week': ('date', weeks, week_values, self.first),
+                       'month': ('date', months, month_values, self.first),
+                       'billable': ('billable', None, [False, True], 0)}
+    for (name, (column, lookup, values, first)) in self.dimensions.items():
+      if lookup is not None and numpy is not None:
+        self.dimensions[name] = (column, numpy.array(lookup, 'int32'), values, first)
+    instrument.stop(stage, self.rows)
+
+  def _calendar(self):
+    "The week and month codes of every day from the first to the last."
+    if self.rows == 0:
+      return ([], [], [], [])
+    date = datetime.date.fromordinal(self.first)
+    last = datetime.date.fromordinal(self.last)
+    weeks = []
+    months = []
+    while date <= last:
+      weeks.append(date.isocalendar()[:2])
+      months.append(unicode(date.strftime("%Y-%m")))
+      date += datetime.timedelta(days=1)
+    return _encode(weeks) + _encode(months)
+
+  def aggregate(self, dimensions, start, stop, **where):
+    """
+      The hours summed by dimensions from start to stop, in the same order
+      and with the same values as Statistics.aggregate() would return them
+      from the DB the snapshot was exported from.
+    """
+    for name in set(dimensions) | set(where.keys()):
+      if name not in DIMENSIONS:
+        raise Exception, "Unknown dimension %s" % name
+    stage = instrument.start("snapshot aggregate")
+    (first, last) = (_ordinal(start), _ordinal(stop))
+    # The weeks and months are restricted as dates
+    if where.has_key('week'):
+      (year, week) = where.pop('week')
+      jan4 = datetime.date(year, 1, 4)  # Always in week 1
+      monday = jan4 + datetime.timedelta(days=7*(week-1) - jan4.weekday())
+      (first, last) = (max(first, monday.toordinal()), min(last, monday.toordinal() + 6))
+    if where.has_key('month'):
+      (year, month) = map(int, where.pop('month').split("-"))
+      (first, last) = (max(first, datetime.date(year, month, 1).toordinal()),
+                       min(last, datetime.date(year, month, calendar.monthrange(year, month)[1]).toordinal()))
+
+    rows = self._between(first, last)
+    for name, value in where.items():
+      values = self.dimensions[name][2]
+      if value not in values:
+        rows = rows[:0]
+        break
+      codes = self._codes(name, rows)
+      if numpy is not None:
+        rows = rows[codes == values.index(value)]
+      else:
+        code = values.index(value)
+        rows = [row for (row, c) in zip(rows, codes) if c == code]
+
+    codes = [self._codes(name, rows) for name in dimensions]
+    if numpy is not None:
+      result = self._sum_numpy(dimensions, rows, codes)
+    else:
+      result = self._sum(dimensions, rows, codes)
+    instrument.stop(stage, len(rows))
+    return result
+
+  def _between(self, first, last):
+    """
+      The rows from day first to day last. The last of them is kept, the
+      statistics of a month usually ask for the same days over and over.
+    """
+    if self.between is None or self.between[0] != (first, last):
+      if numpy is not None:
+        rows = numpy.nonzero((self.date >= first) & (self.date <= last))[0]
+      else:
+        rows = [i for i in xrange(self.rows) if first <= self.date[i] <= last]
+      self.between = ((first, last), rows)
+    return self.between[1]
+
+  def _codes(self, name, rows):
+    "The codes of dimension name for rows."
+    (column, lookup, values, first) = self.dimensions[name]
+    column = getattr(self, column)
+    if numpy is not None:
+      codes = column[rows] - first
+      if lookup is not None:
+        codes = lookup[codes]
+      return codes
+    codes = [column[row] - first for row in rows]
+    if lookup is not None:
+      codes = [lookup[code] for code in codes]
+    return codes
+
+  def _sum(self, dimensions, rows, codes):
+    groups = {}
+    result = []
+    hours = self.hours
+    for (row, key) in zip(rows, zip(*codes) or [()] * len(rows)):
+      group = groups.get(key)
+      if group is None:
+        group = groups[key] = len(result)
+        result.append([self.dimensions[name][2][code] for (name, code) in zip(dimensions, key)] + [0.0])
+      result[group][-1] += hours[row]
+    return map(tuple, result)
+
+  def _sum_numpy(self, dimensions, rows, codes):
+    if len(rows) == 0:
+      return []
+    # One number per group, in the order the groups first appear
+    key = numpy.zeros(len(rows), 'int64')
+    for (name, column) in zip(dimensions, codes):
+      key = key * len(self.dimensions[name][2]) + column
+    (groups, firsts, inverse) = numpy.unique(key, return_index=True, return_inverse=True)
+    sums = numpy.bincount(inverse, self.hours[rows]).tolist()
+    result = []
+    for group in numpy.argsort(firsts, kind='mergesort').tolist():
+      row = firsts[group]
+      result.append(tuple([self.dimensions[name][2][column[row]] for (name, column) in zip(dimensions, codes)] +
+                          [sums[group]]))
+    return result
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestSnapshot(unittest.TestCase):
+
+  def setUp(self):
+    (fd, self.path) = tempfile.mkstemp()
+    os.close(fd)
+    # Written by the writer of export(), without a DB
+    dates = [datetime.date(2009, 3, 1), datetime.date(2009, 3, 2), datetime.date(2009, 3, 2), datetime.date(2009, 4, 1)]
+    header = {'rows': 4, 'byteorder': sys.byteorder,
+              'employees': [u"Anna", u"Bo"], 'offices': [u"Göteborg", None],
+              'projects': [u"Web", u"Internal"], 'customers': [u"Volvo", u"Purple Scout"],
+              'tasks': [u"Development", u"Meeting"]}
+    columns = {'date': [date.toordinal() for date in dates],
+               'employee': [0, 1, 0, 0], 'project': [0, 1, 0, 1], 'task': [0, 1, 0, 0],
+               'billable': [1, 0, 1, 0], 'hours': [8.0, 2.0, 4.5, 1.0]}
+    _write(self.path, header, columns)
+    self.snapshot = Snapshot(self.path)
+
+  def tearDown(self):
+    del self.snapshot
+    os.unlink(self.path)
+
+  def testAggregate(self):
+    self.assertEquals([(u"Anna", u"Development", 12.5), (u"Bo", u"Meeting", 2.0)],
+                      self.snapshot.aggregate(('employee', 'task'), "2009-03-01", "2009-03-31"))
+    self.assertEquals([(u"Volvo", u"Göteborg", True, 12.5), (u"Purple Scout", None, False, 2.0),
+                       (u"Purple Scout", u"Göteborg", False, 1.0)],
+                      self.snapshot.aggregate(('customer', 'office', 'billable'), "2009-01-01", "2009-12-31"))
+
+  def testWhere(self):
+    self.assertEquals([((2009, 9), 8.0), ((2009, 10), 6.5)],
+                      self.snapshot.aggregate(('week',), "2009-01-01", "2009-12-31", month=u"2009-03"))
+    self.assertEquals([(u"Bo", 2.0), (u"Anna", 4.5)],
+                      self.snapshot.aggregate(('employee',), "2009-01-01", "2009-12-31", week=(2009, 10)))
+    self.assertEquals([(u"Meeting", 2.0)], self.snapshot.aggregate(('task',), "2009-03-01", "2009-03-31", employee=u"Bo"))
+    self.assertEquals([], self.snapshot.aggregate(('task',), "2009-03-01", "2009-03-31", employee=u"Nobody"))
+    self.assertRaises(Exception, self.snapshot.aggregate, ('year',), "2009-03-01", "2009-03-31")
+
+
+if __name__ == "__main__":
+  parser = OptionParser(usage="Usage: python snapshot.py [options] FILE [YYYY-MM[..YYYY-MM]]")
+  parser.add_option("-e", "--export", dest="export", action="store_true", default=False,
+                    help="write the daily hours in the DB to FILE")
+  parser.add_option("-g", "--group-by", dest="dimensions", default="employee,task",
+                    help="the dimensions to sum the hours of the months by (default employee,task)")
+  parser.add_option("-t", "--test", dest="test", action="store_true", default=False,
+                    help="run the unit tests")
+  (options, args) = parser.parse_args()
+  if options.test:
+    sys.argv = sys.argv[:1]
+    unittest.main()
+  elif len(args) == 0:
+    parser.print_usage()
+  elif options.export:
+    from config import cfg
+    logging.basicConfig(level=cfg['loglevel'],format=cfg['logformat'])
+    export(args[0])
+  else:
+    snapshot = Snapshot(args[0])
+    period = (len(args) > 1 and args[1]) or "0001-01..9999-12"
+    (first, last) = (period.split("..") + [period])[:2]
+    (year, month) = map(int, last.split("-"))
+    stop = "%s-%02d" % (last, calendar.monthrange(year, month)[1])
+    for row in snapshot.aggregate(options.dimensions.split(","), "%s-01" % first, stop):
+      print "\t".join([unicode(value).encode('utf-8') for value in row])
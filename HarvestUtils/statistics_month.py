@@ -22,44 +22,315 @@ You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import array
 import calendar
+import datetime
 import time
 import sys
 
+from sqlalchemy import and_, func, select
+
+import instrument
+from config import cfg
 from model import *
 
+try:
+  import numpy
+except ImportError:
+  numpy = None  # WeekStatistics sums in a Python loop instead
+
+# The dimensions of Statistics.hours_by_task()
+HOURS_BY_TASK = ('employee', 'customer', 'project', 'task')
+
+def nest(rows):
+  """
+    Nest rows of (key, ..., key, value), e.g. from Statistics.aggregate(),
+    in dicts: result[key][...][key] = value.
+  """
+  result = {}
+  for row in rows:
+    level = result
+    for key in row[:-2]:
+      if not level.has_key(key):
+        level[key] = {}
+      level = level[key]
+    level[row[-2]] = row[-1]
+  return result
+
 class Statistics(object):
+  """
+    Statistics for the month of datemodel, or for all months from it to
+    the month of last. aggregate() and what is built on it read the hours
+    from snapshot, a snapshot.Snapshot, instead of the DB if one is given.
+  """
 
-  def __init__(self,datemodel):
+  def __init__(self,datemodel,last=None,snapshot=None):
     if not isinstance(datemodel, DateModel):
       raise Exception, "This class needs a DateModel instance as first argument"
+    if last is None:
+      last = datemodel
     self.date = datemodel
+    self.snapshot = snapshot
     self.start = self.date.get_month_start()
-    self.stop = self.date.get_month_stop()
+    self.stop = last.get_month_stop()
+
+  # The dimensions aggregate() can group by. week is (ISO year, ISO week)
+  # and month "YYYY-MM".
+  DIMENSIONS = ('employee', 'customer', 'project', 'task', 'office', 'week', 'month', 'billable')
+
+  def aggregate(self, dimensions, start=None, stop=None, **where):
+    """
+      The hours summed by dimensions, names from DIMENSIONS, in one query on
+      DailyHours. The hours are those from start to stop, by default the
+      months of this Statistics. where restricts dimensions to a value,
+      e.g. employee=u"Name" or week=(2009, 10). Returns a list of (the
+      value of every dimension, in order, hours) in the order the groups
+      first appear in the DB.
+    """
+    if self.snapshot is not None:
+      return self.snapshot.aggregate(dimensions, start or self.start, stop or self.stop, **where)
+    stage = instrument.start("aggregate")
+    rows = session.execute(self.aggregate_query(dimensions, start, stop, **where), mapper=DailyHours)
+    if 'week' not in dimensions:
+      rows = [tuple(row) for row in rows]
+    else:
+      # The week is selected as the two columns of Day
+      week = list(dimensions).index('week')
+      rows = [row[:week] + ((row[week], row[week + 1]),) + row[week + 2:] for row in map(tuple, rows)]
+    instrument.stop(stage, len(rows))
+    return rows
+
+  def aggregate_query(self, dimensions, start=None, stop=None, **where):
+    "The select of aggregate(), with ISO year and week as two columns."
+    rollup = DailyHours.table
+    project = Project.table
+    customer = Customer.table
+    employee = Employee.table
+    office = Office.table
+    day = Day.table
+    columns = {'employee': rollup.c.employee_name,
+               'customer': customer.c.name,
+               'project': project.c.name,
+               'task': rollup.c.task,
+               'office': office.c.name,
+               'week': [day.c.iso_year, day.c.iso_week],
+               'month': func.substr(rollup.c.date, 1, 7),
+               'billable': rollup.c.billable}
+    used = set(dimensions) | set(where.keys())
+    for name in used:
+      if not columns.has_key(name):
+        raise Exception, "Unknown dimension %s" % name
+
+    conditions = [rollup.c.date >= (start or self.start), rollup.c.date <= (stop or self.stop)]
+    for name, value in where.items():
+      if name == 'week':
+        (monday, sunday) = iso_week(*value)
+        conditions += [rollup.c.date >= monday, rollup.c.date <= sunday]
+      else:
+        conditions.append(columns[name] == value)
+    if 'week' in dimensions:
+      conditions.append(rollup.c.date == day.c.date)
+    if 'customer' in used or 'project' in used:
+      conditions.append(rollup.c.project_id == project.c.id)
+    if 'customer' in used:
+      conditions.append(project.c.customer_id == customer.c.id)
+    from_obj = []
+    if 'office' in used:
+      # Employees without an office are grouped under None
+      from_obj.append(rollup.join(employee).outerjoin(office))
+
+    groups = []
+    for name in dimensions:
+      if name == 'week':
+        groups += columns[name]
+      else:
+        groups.append(columns[name])
+    return select(groups + [func.sum(rollup.c.hours)], and_(*conditions), from_obj=from_obj,
+                  group_by=groups, order_by=[func.min(rollup.c.id)])
 
   def by_employee(self,employee):
-    tasks = Task.query.filter(Task.date >= self.start)
-    tasks = tasks.filter(Task.date <= self.stop)
-    tasks = tasks.filter(Task.employee.has(name=employee))
-    return self._aggregate_tasks(tasks)
+    "The hours of employee in the month by task name."
+    return dict(self.aggregate(('task',), employee=employee))
 
   def by_task(self,name):
-    pass
+    "The hours of the task name in the month by employee name."
+    return dict(self.aggregate(('employee',), task=name))
+
+  def hours_by_task(self):
+    """
+      The hours of the month summed by employee, customer, project and
+      task. Returns a list of (employee name, customer, project, task,
+      hours), see aggregate().
+    """
+    return self.aggregate(HOURS_BY_TASK)
 
-  def _aggregate_tasks(self,tasks):
+  def hours_by_month(self):
     """
-      Merge the hours for a number of tasks by name, return a dict with task name as key.
+      The same as hours_by_task(), for every month in one query. Returns a
+      dict from "YYYY-MM" to the rows of that month.
     """
     result = {}
-    for task in tasks:
-      #print "Adding %0.2f hours to %s" % (task.hours, task.name)
-      if not result.has_key(task.name):
-        result[task.name] = task.hours
-      else:
-        result[task.name] += task.hours
+    for row in self.aggregate(('month',) + HOURS_BY_TASK):
+      result.setdefault(row[0], []).append(row[1:])
+    return result
 
+  def purchase_orders(self):
+    """
+      The purchase orders that overlap the month, in one query. Returns a
+      dict from employee name to a list of PurchaseOrder.
+    """
+    stage = instrument.start("purchase orders")
+    result = {}
+    for po in self.purchase_orders_query():
+      result.setdefault(po.employee_name, []).append(po)
+    # Sorted by id here, ordering the query by id (which SQLAlchemy does by
+    # default) makes SQLite scan the table in id order
+    for pos in result.values():
+      pos.sort(key=lambda po: po.id)
+    instrument.stop(stage, sum(map(len, result.values())))
     return result
 
+  def purchase_orders_query(self):
+    pos = PurchaseOrder.query.filter(PurchaseOrder.start <= self.stop)
+    pos = pos.filter(PurchaseOrder.stop >= self.start)
+    return pos.order_by(PurchaseOrder.start)
+
+
+def iso_week(year, week):
+  "Return the Monday and the Sunday of an ISO week as datetime.date."
+  jan4 = datetime.date(year, 1, 4)  # Always in week 1
+  monday = jan4 + datetime.timedelta(days=7*(week-1) - jan4.weekday())
+  return (monday, monday + datetime.timedelta(days=6))
+
+
+class WeekStatistics(object):
+  """
+    Worked and billable hours per employee and ISO week for some weeks of a
+    year, e.g. the cfg['purple_heart'] weeks of a month. The DailyHours of
+    the weeks are read with one query, their ISO weeks from Day, into
+    columns and summed per employee and week in one go. Kompledighet,
+    Komptid and Uttag av komp do not count as worked time, tasks in cfg['billable'] are billable (Purple Heart) time.
+    The Internal tasks are listed as they were reported, so they are read
+    from Task with a second query.
+  """
+
+  NOT_WORKED = (u"Kompledighet", u"Komptid", u"Uttag av komp")
+
+  def __init__(self, year, weeks):
+    self.weeks = list(weeks)
+    self.ranges = [iso_week(year, week) for week in self.weeks]
+    self.employees = {}   # Employee name -> row in the sums
+    self.internal = {}    # (employee name, week) -> [(task, date, hours)]
+    self._load()
+
+  def query(self):
+    rollup = DailyHours.table
+    day = Day.table
+    columns = [rollup.c.employee_name, day.c.iso_week, rollup.c.task, rollup.c.hours]
+    return select(columns,
+                  and_(rollup.c.date >= self.ranges[0][0], rollup.c.date <= self.ranges[-1][1],
+                       rollup.c.date == day.c.date),
+                  order_by=[rollup.c.id])
+
+  def internal_query(self):
+    task = Task.table
+    project = Project.table
+    columns = [task.c.employee_name, task.c.date, task.c.name, task.c.hours]
+    return select(columns,
+                  and_(task.c.date >= self.ranges[0][0], task.c.date <= self.ranges[-1][1],
+                       task.c.project_id == project.c.id, project.c.name == u"Internal",
+                       task.c.name != u"Kompetensutveckling"),
+                  order_by=[task.c.id])
+
+  def _load(self):
+    stage = instrument.start("weeks")
+    weeks = dict([(week, i) for i, week in enumerate(self.weeks)])
+    billable = set()
+    for name in cfg['billable']:
+      if not isinstance(name, unicode):
+        name = unicode(name, 'utf-8')
+      billable.add(name)
+
+    # One entry per row: the (employee, week) it is summed into, and how
+    # much of it is worked and billable time
+    groups = array.array('i')
+    worked = array.array('d')
+    billed = array.array('d')
+    for (employee, iso_week, name, hours) in session.execute(self.query(), mapper=DailyHours):
+      week = weeks.get(iso_week)
+      if week is None:
+        continue
+      row = self.employees.setdefault(employee, len(self.employees))
+      groups.append(row * len(self.weeks) + week)
+      if name in WeekStatistics.NOT_WORKED:
+        worked.append(0.0)
+      else:
+        worked.append(hours)
+      if name in billable:
+        billed.append(hours)
+      else:
+        billed.append(0.0)
+
+    size = len(self.employees) * len(self.weeks)
+    self.worked = self._sum(groups, worked, size)
+    self.billable = self._sum(groups, billed, size)
+
+    days = {}
+    for week, (monday, sunday) in zip(self.weeks, self.ranges):
+      for day in range(7):
+        days[monday + datetime.timedelta(days=day)] = week
+    for (employee, date, name, hours) in session.execute(self.internal_query(), mapper=Task):
+      week = days.get(date)
+      if week is not None:
+        self.internal.setdefault((employee, week), []).append((name, date, hours))
+    instrument.stop(stage, len(groups))
+
+  def _sum(self, groups, values, size):
+    "Sum values by group, groups being numbers below size."
+    if numpy is not None and len(groups) > 0:
+      sums = numpy.bincount(numpy.frombuffer(groups, 'i'), numpy.frombuffer(values, 'd'))
+      return sums.tolist() + [0.0] * (size - len(sums))
+    sums = [0.0] * size
+    for group, value in zip(groups, values):
+      sums[group] += value
+    return sums
+
+  def _get(self, sums, employee, week):
+    row = self.employees.get(employee)
+    if row is None:
+      return 0.0
+    return sums[row * len(self.weeks) + self.weeks.index(week)]
+
+  def week_range(self, week):
+    "The Monday and Sunday of week."
+    return self.ranges[self.weeks.index(week)]
+
+  def week_total(self, employee, week):
+    "The hours employee worked in week."
+    return self._get(self.worked, employee, week)
+
+  def purple_heart_time(self, employee, week):
+    "The billable hours of employee in week."
+    return self._get(self.billable, employee, week)
+
+  def internal_tasks(self, employee, week):
+    "The (task, date, hours) of the Internal project, except Kompetensutveckling."
+    return self.internal.get((employee, week), [])
+
+  def normal_time(self, employee):
+    "The hours employee should work in a week, cfg['parttime'] applied."
+    normal_time = cfg['normal_time']
+    if cfg['parttime'].has_key(employee.encode("utf-8")):
+      normal_time = normal_time * cfg['parttime'][employee.encode("utf-8")]
+    return normal_time
+
+  def overtime(self, employee, week):
+    return self.week_total(employee, week) - self.normal_time(employee)
+
+  def purple_heart(self, employee, week):
+    "True if employee billed a full week, part time or not."
+    return self.purple_heart_time(employee, week) >= cfg['normal_time']
+
 
 class DateModel(object):
 
@@ -71,8 +342,7 @@ class DateModel(object):
     self.year =  int(self.date.split("-")[0])
     self.month = int(self.date.split("-")[1])
     self.day = int(self.date.split("-")[2])
-    self.cal = calendar.Calendar()
-    self.days = max(self.cal.itermonthdays(self.year,self.month))
+    self.days = calendar.monthrange(self.year,self.month)[1]
 
   def get_month_start(self):
     return  "%d-%02d-01" % (self.year,self.month)
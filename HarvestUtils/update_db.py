@@ -22,49 +22,94 @@ You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import inspect 
 import logging
 import os
 import sys
+from optparse import OptionParser
 
+import instrument
 from config import cfg
+from csvparser import sniff
 from mapper import CSVDBMapper, POMapper, CWMapper   
-from model import TimeEntry, POEntry, CWEntry
+from model import HARVEST, PURCHASE_ORDERS, COWORKERS, DailyHours, Day, metadata, session
+from pipeline import Pipeline
 
 log = logging.getLogger("update_db")
 
-def _get_mapper(path):
-  handle = file(path, 'r')
-  length = len(handle.readline().split(","))   
-  
-  if length is len(inspect.getargspec(TimeEntry.__init__)[0]) - 1:
-    log.info("File %s contains %d fields, it is a Harvest file" % (path, length))
-    return CSVDBMapper(path)
-  elif length is len(inspect.getargspec(POEntry.__init__)[0]) - 1:
-    log.info("File %s contains %d fields, it is a PurchaseOrder file" % (path, length))
-    return POMapper(path)
-  elif length is len(inspect.getargspec(CWEntry.__init__)[0]) - 1:
-    log.info("File %s contains %d fields, it is a CoWorker file" % (path, length))
-    return CWMapper(path)
+def _get_mapper(path, bulk=None, batch_size=None, resume=False, processes=1, incremental=None, columnar=None):
+  schema = sniff(path)
+  if schema is None:
+    log.warning("File %s is of UNKNOWN type!" % path)
+    return None
+
+  log.info("File %s is a %s file" % (path, schema.name))
+  if schema is HARVEST:
+    return CSVDBMapper(path, bulk, batch_size, resume, processes, incremental, columnar)
+  elif schema is PURCHASE_ORDERS:
+    return POMapper(path, bulk, batch_size, resume)
+  elif schema is COWORKERS:
+    return CWMapper(path, bulk, batch_size, resume)
   else:
-    log.warning("File %s contains %d fields, it is of UNKNOWN type!" % (path, length))
+    log.warning("There is no mapper for %s files" % schema.name)
     return None
 
 if __name__ == "__main__":
   logging.basicConfig(level=cfg['loglevel'],format=cfg['logformat'])
-  if len(sys.argv) > 1:
+  parser = OptionParser(usage="Usage: update_db.py [options] <csvfile>")
+  parser.add_option("-b", "--batch-size", dest="batch_size", type="int",
+                    help="number of rows per transaction (default from config.py)")
+  parser.add_option("--no-bulk", dest="bulk", action="store_false",
+                    help="commit every row instead of bulk loading")
+  parser.add_option("-r", "--resume", dest="resume", action="store_true", default=False,
+                    help="continue each file after the last batch that was committed")
+  parser.add_option("--no-incremental", dest="incremental", action="store_false",
+                    help="load every Harvest entry, also those already in the DB")
+  parser.add_option("--columnar", dest="columnar", action="store_true",
+                    help="parse Harvest files into column batches (default from config.py)")
+  parser.add_option("-j", "--jobs", dest="processes", type="int", default=1,
+                    help="number of processes that parse Harvest files, 0 for one per CPU")
+  parser.add_option("-t", "--threads", dest="threads", type="int", default=2,
+                    help="number of files parsed while the DB is written, 0 to parse and write in turn")
+  parser.add_option("--rebuild-rollup", dest="rebuild", action="store_true", default=False,
+                    help="recompute the daily hours and the days the reports use from the tasks in the DB")
+  parser.add_option("--profile", dest="profile", metavar="FILE",
+                    help="write the time, rows and SQL of every stage to FILE, as JSON or for flamegraph.pl if it ends with .folded")
+  (options, args) = parser.parse_args()
+  if options.profile is not None:
+    instrument.enable(metadata.bind)
+  if options.rebuild:
+    log.info("Rebuilding the daily hours")
+    DailyHours.rebuild()
+    Day.rebuild()
+    session.commit()
+
+  if len(args) > 0:
     
-    for csvfile in sys.argv[1:]:
+    mappers = []
+    for csvfile in args:
       if os.path.exists(csvfile):
-        log.info("Starting to map %s to the DB" % csvfile)
-        mapper = _get_mapper(csvfile)
+        mapper = _get_mapper(csvfile, bulk=options.bulk, batch_size=options.batch_size,
+                             resume=options.resume, processes=options.processes or None,
+                             incremental=options.incremental, columnar=options.columnar)
       
         if mapper is not None:
-          mapper.map()
+          mappers.append(mapper)
         else:
           log.error("Unknown file format for %s" % csvfile)
       else:
         log.error("File %s does not exist. Exiting" % csvfile)
 
-  else:
-    print "Usage: update_db.py <csvfile>"
+    # The files are written in the order they were given
+    if options.threads > 0:
+      Pipeline(mappers, options.threads).run()
+    else:
+      for mapper in mappers:
+        log.info("Starting to map %s to the DB" % mapper.source)
+        mapper.read_ahead = False
+        mapper.map()
+
+  elif not options.rebuild:
+    parser.print_usage()
+
+  if options.profile is not None:
+    instrument.disable().write(options.profile)